@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the Monte Carlo pricer: path generation throughput, pricing time,
+peak memory and pricing error against the Black-Scholes closed form, over a grid
+of numbers of paths and time steps. Results are written as JSON, e.g.
+
+python Benchmark.py --npaths 10000 100000 --nperiods 12 252 --output bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy
+
+from Pricing import PathGenerator, Option, BlackScholesPrice
+
+
+def _Best(fun,repeat):
+    """
+    Returns the best elapsed time of several calls of a function, and the result
+    of the last call
+
+    Parameters
+    ----------
+    fun: function(() -> object)
+        Function to time
+    repeat: int
+        Number of calls
+
+    Returns
+    -------
+    type: tuple
+        (float, object) best time in seconds and result
+    """
+    best = float('inf')
+    result = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = fun()
+        best = min(best,time.perf_counter() - start)
+    return best, result
+
+
+def BenchmarkCase(npath,nperiod,s0=100.0,k=100.0,r=0.01,sigma=0.2,t=1.0,repeat=3,seed=0,**kwargs):
+    """
+    Benchmark the pricing of a European call for one number of paths and time
+    steps
+
+    Parameters
+    ----------
+    npath: int
+        Number of paths
+    nperiod: int
+        Number of time steps (regular grid up to the expiry)
+    s0, k, r, sigma, t: float (optional)
+        Initial value, strike, risk-free rate, volatility and expiry of the call
+    repeat: int (optional)
+        Number of timed runs, the best one is kept (default: 3)
+    seed: int (optional)
+        Seed of the paths (default: 0)
+    **kwargs: optional arguments of PathGenerator (scheme, computedtype, ...)
+
+    Returns
+    -------
+    type: dict
+        Timings, throughput, peak memory and pricing error of the case
+    """
+    dates = numpy.arange(1,nperiod + 1) * (t / nperiod)
+    pg = PathGenerator(npath,t,t / nperiod,'bs',r,sigma,seed=seed,dates=dates,curve=r,**kwargs)
+    payoff = lambda x: numpy.maximum(x - k,0.0)
+    option = Option(payoff,pg,t,'terminal')
+    gentime, _ = _Best(lambda: pg.GeneratePaths(s0),repeat)
+    #A new option for each run: the discounted payoffs are cached by the option
+    pricetime, price = _Best(lambda: Option(payoff,pg,t,'terminal').Price(),repeat)
+    #Traced separately: tracemalloc slows down the allocations
+    pg.Values = pg.Terminal = pg.Normals = None
+    tracemalloc.start()
+    pg.GeneratePaths(s0)
+    option.Price()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    exact = BlackScholesPrice(s0,k,r,sigma,t)
+    halfwidth = 0.5 * (price[2] - price[0])
+    stderr = halfwidth / 1.96
+    return {'NPath': npath,
+            'NPeriod': nperiod,
+            'GenerateSeconds': gentime,
+            'PathsPerSecond': npath / gentime,
+            'StepsPerSecond': npath * nperiod / gentime,
+            'PriceSeconds': pricetime,
+            'PeakMemoryBytes': peak,
+            'Price': float(price[1]),
+            'ClosedForm': exact,
+            'Error': float(price[1] - exact),
+            'HalfWidth': float(halfwidth),
+            'InsideInterval': bool(price[0] <= exact <= price[2]),
+            #Variance of the estimator times the time spent: lower is better, and
+            #independent of the number of paths
+            'WorkNormalizedVariance': float(stderr ** 2 * (gentime + pricetime))}
+
+
+def RunBenchmark(npaths,nperiods,repeat=3,seed=0,**kwargs):
+    """
+    Run BenchmarkCase over a grid of numbers of paths and time steps
+
+    Parameters
+    ----------
+    npaths: list
+        Numbers of paths
+    nperiods: list
+        Numbers of time steps
+    repeat: int (optional)
+        Number of timed runs of each case (default: 3)
+    seed: int (optional)
+        Seed of the paths (default: 0)
+    **kwargs: optional arguments of PathGenerator
+
+    Returns
+    -------
+    type: dict
+        Description of the environment and settings ('Meta') and list of the
+        results of each case ('Results')
+    """
+    meta = {'Time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'Python': sys.version.split()[0],
+            'NumPy': numpy.__version__,
+            'Platform': platform.platform(),
+            'CPUCount': os.cpu_count(),
+            'Repeat': repeat,
+            'Seed': seed,
+            'Options': {key: str(value) for key, value in kwargs.items()}}
+    results = []
+    for npath in npaths:
+        for nperiod in nperiods:
+            results.append(BenchmarkCase(npath,nperiod,repeat=repeat,seed=seed,**kwargs))
+    return {'Meta': meta,'Results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the Monte Carlo pricer")
+    parser.add_argument('--npaths',type=int,nargs='+',default=[10000,100000])
+    parser.add_argument('--nperiods',type=int,nargs='+',default=[12,52,252])
+    parser.add_argument('--repeat',type=int,default=3)
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--scheme',choices=['euler','exact'],default='euler')
+    parser.add_argument('--computedtype',choices=['float64','float32'],default='float64')
+    parser.add_argument('--storage',choices=['full','terminal'],default='full')
+    parser.add_argument('--antithetic',action='store_true')
+    parser.add_argument('--output',default=None,help="JSON file (default: standard output)")
+    args = parser.parse_args()
+    report = RunBenchmark(args.npaths,args.nperiods,args.repeat,args.seed,scheme=args.scheme,
+                          computedtype=numpy.dtype(args.computedtype),storage=args.storage,
+                          antithetic=args.antithetic)
+    if args.output is None:
+        json.dump(report,sys.stdout,indent=2)
+        print()
+    else:
+        with open(args.output,'w') as f:
+            json.dump(report,f,indent=2)
@@ -5,18 +5,37 @@ Created on Wed Jan 18 10:28:21 2017
 @author: clem
 """
 
+import copy
+import hashlib
+import json
 import math
+import os
+import threading
+import time
+import concurrent.futures
 import numpy.random
-import scipy.stats
-import matplotlib.pyplot as plt
-import sklearn.utils as sku
+#scipy (Sobol sampling, normal and Student distributions) and matplotlib (plots) are imported
+#when first needed, so that importing the module stays fast
+
+#Above this number of samples, Option.Price uses the analytic standard error by default
+ANALYTIC_MIN_SAMPLES = 100000
+#Below this number of samples, the analytic interval uses the Student-t quantile
+#instead of 1.96 (e.g. the few replicates of the 'sobol' sampling)
+STUDENT_MAX_SAMPLES = 1000
+#Maximum number of elements of the resample index matrix drawn at once by Bootstrap
+BOOTSTRAP_CHUNK_ELEMENTS = 2**22
 
 
 class Path:
     """
     Class to represent the path of a random variable following a Brownian motion (e.g. stock price)
+    
+    When created by a PathGenerator, a Path is a lightweight view on one row of the
+    generator path matrix: no value is copied and writes go to the matrix
     """
-    def __init__(self,s0,nPeriod,deltaT):
+    __slots__ = ('NPeriod','DeltaT','Values','Times')
+    
+    def __init__(self,s0,nPeriod,deltaT,values=None,times=None):
         """
         Parameters
         ----------
@@ -26,6 +45,11 @@ class Path:
             Number of period to generate
         deltaT: float
             Inter-period time interval
+        values: numpy.ndarray (optional)
+            Existing array of nPeriod values to wrap without copy (s0 is then
+            ignored)
+        times: numpy.ndarray (optional)
+            Date of each period (default: regular grid with a deltaT step)
             
         Returns
         -------
@@ -33,7 +57,12 @@ class Path:
         """
         self.NPeriod = nPeriod
         self.DeltaT = deltaT
-        self.Values = [s0 for i in range(nPeriod)]
+        if values is None:
+            values = numpy.full(nPeriod,s0,dtype=float)
+        self.Values = values
+        if times is None:
+            times = numpy.arange(nPeriod) * deltaT
+        self.Times = times
     
     def GetLastItem(self):
         """
@@ -95,14 +124,10 @@ class Path:
         Returns
         -------
         type: float
-            Value of the random variable at the selected date
+            Value of the random variable at the selected date (linear interpolation
+            between the two closest periods)
         """
-        frac, ind = math.modf(date / self.DeltaT)
-        ind=int(ind)
-        if frac < 0.000001:
-            return self[ind]
-        else:
-            return frac*self[ind]+(1-frac)*self[ind+1]
+        return numpy.interp(date,self.Times,self.Values)
             
     def Plot(self):
         """
@@ -116,185 +141,488 @@ class Path:
         -------
         None
         """
-        plt.plot([self.DeltaT * period for period in range(self.NPeriod)],self.Values)
+        import matplotlib.pyplot as plt
+        plt.plot(self.Times,self.Values)
 
-class PathGenerator:
+class Model:
     """
-    Class generating Path instances to price derivatives
+    "Abstract" class of the dynamics used by PathGenerator. A model advances the
+    state of all the paths by one time step at once (vectorized kernel)
+    
+    The generator is passed to each call, so that the model reads its current
+    StepDrift, Vol, Times and Scheme attributes. The state must keep the type of
+    the generator ComputeDType attribute: scalars of the step are Python floats,
+    which do not promote float32 arrays
     """
-    def __init__(self,nPath,totaltime,deltaT,model, drift, vol,**kwargs):
+    Name = None
+    NFactors = 1
+    #True if the paths are proportional to the initial value
+    Homogeneous = True
+    #True if the paths depend on the Vol attribute of the generator
+    UsesVol = True
+    
+    def __init__(self,generator,**kwargs):
         """
         Parameters
         ----------
-        nPath: int
-            Number of path to generate
-        totaltime: float
-            Total time of each path
-        deltaT: float
-            Time interval between two periods
-        drift: float/function
-            Drift of the Brownian motion
-        model: str
-            Name of the model to use. Currently, only "black-scholes" supported
-        vol: float/function
-            Volatility of the Brownian motion
-        **kwargs: optional arguments to provide for certain model
+        generator: PathGenerator
+            PathGenerator instance using the model
+        **kwargs: model parameters (PathGenerator keyword arguments)
         """
-        self.TotalTime = totaltime
-        self.NPath = nPath
-        self.NPeriod = int(totaltime/deltaT)
-        self.DeltaT = deltaT
-        self.Drift = drift
-        self.Vol = vol
+        pass
+        
+    def Initial(self,generator,s0,n):
+        """
+        Returns the initial state of n paths
         
-        if model.lower() in ['bs','black-scholes','black scholes','merton','black-scholes-merton','black scholes merton']:           
-            self.DriftFun = self._BSDriftFun
-            self.VolFun = self._BSVolFun
+        Parameters
+        ----------
+        generator: PathGenerator
+            PathGenerator instance
+        s0: float
+            Initial value of the random variable
+        n: int
+            Number of paths
             
+        Returns
+        -------
+        type: numpy.ndarray
+            Initial state
+        """
+        return numpy.full(n,s0,dtype=generator.ComputeDType)
     
-    def _BSDriftFun(self,S,t,rt,sigmat):
+    def Grid(self,generator):
         """
-        Drift function used by the Black-Scholes-Merton model
+        Update the precomputed quantities depending on the date grid of the 
+        generator. Called when the horizon of the generator is extended
+        
+        Parameters
+        ----------
+        generator: PathGenerator
+            PathGenerator instance
+            
+        Returns
+        -------
+        None
         """
-        return self.Drift * S
+        pass
         
-    def _BSVolFun(self,S,t,r,sigmat):
+    def Step(self,generator,state,j,z,r):
         """
-        Volatility function used by the Black-Scholes-Merton model
+        Advance the state of all the paths from Times[j] to Times[j+1]
+        
+        Parameters
+        ----------
+        generator: PathGenerator
+            PathGenerator instance
+        state: numpy.ndarray
+            State of the paths at Times[j]
+        j: int
+            Index of the time step
+        z: numpy.ndarray
+            Standard normal shocks of the step, (n,) or (n, NFactors)
+        r: float
+            Forward risk-free rate of the step
+            
+        Returns
+        -------
+        type: numpy.ndarray
+            State of the paths at Times[j+1]
         """
-        return self.Vol * S * numpy.random.normal(0.0,1.0)
+        raise NotImplementedError
         
-    def _initPaths(self,s0):
+    def Spot(self,state):
+        """
+        Returns the value of the random variable from the state of the paths
+        """
+        return state
+    
+    def Config(self):
+        """
+        Returns the model parameters identifying the generated paths (see PathCache)
+        """
+        return []
+
+
+class BlackScholesModel(Model):
+    """
+    Black-Scholes-Merton model: Euler scheme on the vectorized drift and volatility
+    kernels, or exact log-normal step
+    """
+    Name = 'bs'
+    
+    def DriftKernel(self,generator,S,t,r):
         """
-        Init the attribute Paths as a list of Path instance
+        Vectorized drift function
         
         Parameters
         ----------
-        s0: float
-            Initial value of the random variable
+        generator: PathGenerator
+            PathGenerator instance
+        S: numpy.ndarray
+            Values of all the paths at time t
+        t: float
+            Current date
+        r: float
+            Forward risk-free rate of the step
             
         Returns
         -------
-        None
+        type: numpy.ndarray
+            Drift of each path
         """
-        self.Paths = [Path(s0,self.NPeriod,self.DeltaT) for i in range(self.NPath)]
-        
-    def GeneratePaths(self,s0):
+        return (r if generator.Drift is None else generator.Drift) * S
+    
+    def VolKernel(self,generator,S,t,r):
         """
-        Generate the Path instance to price derivatives
+        Vectorized volatility function. The random shock is not drawn here and must
+        be applied by the caller
         
         Parameters
         ----------
-        s0: float
-            Initial value of the random variable
+        generator: PathGenerator
+            PathGenerator instance
+        S: numpy.ndarray
+            Values of all the paths at time t
+        t: float
+            Current date
+        r: float
+            Forward risk-free rate of the step
             
         Returns
         -------
-        None
+        type: numpy.ndarray
+            Diffusion coefficient of each path
         """
-        self._initPaths(s0)
-        for i in range(self.NPath):
-            S = s0
-            for j in range(self.NPeriod-1):
-                t = (j+1)*self.DeltaT
-                S = S + self.DriftFun(S,t,0.01,0) * self.DeltaT + self.VolFun(S,t,0.01,0) * math.sqrt(self.DeltaT)
-                self.Paths[i][j+1] = S
-                
-    def Discount(self,date):
+        return generator.Vol * S
+    
+    def Step(self,generator,state,j,z,r):
+        g = generator
+        dt = float(g.Steps[j])
+        if g.Scheme == 'exact':
+            return state * numpy.exp(float(g.StepDrift[j] - 0.5 * g.Vol ** 2) * dt + g.Vol * math.sqrt(dt) * z)
+        t = g.Times[j+1]
+        return state + self.DriftKernel(g,state,t,r) * dt + self.VolKernel(g,state,t,r) * z * math.sqrt(dt)
+
+
+class HestonModel(Model):
+    """
+    Heston stochastic volatility model, simulated with a log-Euler step for the 
+    price and a full truncation Euler step for the variance:
+    
+    dS = drift * S * dt + sqrt(v) * S * dW1
+    dv = kappa * (theta - v) * dt + xi * sqrt(v) * dW2,  d<W1,W2> = rho * dt
+    
+    The initial variance is the square of the generator Vol attribute
+    """
+    Name = 'heston'
+    NFactors = 2
+    
+    def __init__(self,generator,**kwargs):
+        """
+        Parameters
+        ----------
+        generator: PathGenerator
+            PathGenerator instance using the model
+        kappa: float
+            Speed of mean reversion of the variance
+        theta: float
+            Long-term variance
+        xi: float
+            Volatility of the variance
+        rho: float
+            Correlation between the price and variance Brownian motions
         """
-        Returns the discount factor for a given date
+        try:
+            self.Kappa = kwargs['kappa']
+            self.Theta = kwargs['theta']
+            self.Xi = kwargs['xi']
+            self.Rho = kwargs['rho']
+        except KeyError as e:
+            raise ValueError("Missing Heston parameter: {}".format(e.args[0]))
         
-        Warnings
-        --------
-        Only provide the discount factor, and do not implement r=f(t) yet        
+    def Initial(self,generator,s0,n):
+        state = numpy.empty((n,2),dtype=generator.ComputeDType)
+        state[:,0] = s0
+        state[:,1] = generator.Vol ** 2
+        return state
         
+    def Step(self,generator,state,j,z,r):
+        dt = float(generator.Steps[j])
+        S = state[:,0]
+        v = state[:,1]
+        vp = numpy.maximum(v,0.0)
+        sqrtvdt = numpy.sqrt(vp * dt)
+        z2 = self.Rho * z[:,0] + math.sqrt(1.0 - self.Rho ** 2) * z[:,1]
+        nextstate = numpy.empty_like(state)
+        nextstate[:,0] = S * numpy.exp((float(generator.StepDrift[j]) - 0.5 * vp) * dt + sqrtvdt * z[:,0])
+        nextstate[:,1] = v + self.Kappa * (self.Theta - vp) * dt + self.Xi * sqrtvdt * z2
+        return nextstate
+        
+    def Spot(self,state):
+        return state[:,0]
+    
+    def Config(self):
+        return [self.Kappa,self.Theta,self.Xi,self.Rho]
+
+
+class LocalVolModel(Model):
+    """
+    Local volatility model dS = drift * S * dt + sigma(S,t) * S * dW, simulated with
+    a log-Euler step. The volatility surface is given on a (time, spot) grid; it is
+    interpolated once on the time grid of the generator, so that each step only 
+    needs a linear interpolation in spot
+    """
+    Name = 'localvol'
+    Homogeneous = False
+    UsesVol = False
+    
+    def __init__(self,generator,**kwargs):
+        """
         Parameters
         ----------
-        date: float
-            Date of the cash flow
+        generator: PathGenerator
+            PathGenerator instance using the model
+        lvtimes: array-like
+            Increasing times of the volatility grid
+        lvspots: array-like
+            Increasing spots of the volatility grid
+        lvsurface: array-like
+            (len(lvtimes), len(lvspots)) local volatilities
+        """
+        try:
+            self.Times = numpy.asarray(kwargs['lvtimes'],dtype=float)
+            self.Spots = numpy.asarray(kwargs['lvspots'],dtype=float)
+            self.Surface = numpy.asarray(kwargs['lvsurface'],dtype=float)
+        except KeyError as e:
+            raise ValueError("Missing local volatility parameter: {}".format(e.args[0]))
+        if self.Surface.shape != (self.Times.shape[0],self.Spots.shape[0]):
+            raise ValueError("The local volatility surface must be of shape (len(lvtimes), len(lvspots))")
+        self.Grid(generator)
+        
+    def Grid(self,generator):
+        #Volatility at the start of each step of the generator
+        self.Table = numpy.empty((generator.NPeriod - 1,self.Spots.shape[0]))
+        for i in range(self.Spots.shape[0]):
+            self.Table[:,i] = numpy.interp(generator.Times[:-1],self.Times,self.Surface[:,i])
+        
+    def Step(self,generator,state,j,z,r):
+        dt = float(generator.Steps[j])
+        sigma = numpy.interp(state,self.Spots,self.Table[j]).astype(state.dtype,copy=False)
+        return state * numpy.exp((float(generator.StepDrift[j]) - 0.5 * sigma ** 2) * dt + sigma * math.sqrt(dt) * z)
+    
+    def Config(self):
+        return [self.Spots.tolist(),self.Table.tolist()]
+
+
+#Registry of the models available to PathGenerator, by lower-case name
+MODELS = {}
+
+def RegisterModel(names,model):
+    """
+    Register a Model class under several names
+    
+    Parameters
+    ----------
+    names: list
+        Names of the model (case insensitive)
+    model: class
+        Subclass of Model
+        
+    Returns
+    -------
+    None
+    """
+    for name in names:
+        MODELS[name.lower()] = model
+
+RegisterModel(['bs','black-scholes','black scholes','merton','black-scholes-merton','black scholes merton'],BlackScholesModel)
+RegisterModel(['heston'],HestonModel)
+RegisterModel(['localvol','local-vol','local vol','local volatility'],LocalVolModel)
+
+
+class TermStructure:
+    """
+    "Abstract" class of the risk-free term structures (continuously compounded 
+    zero rates). All the methods are vectorized over the dates
+    """
+    def ZeroRate(self,t):
+        """
+        Returns the zero rate of each date
+        
+        Parameters
+        ----------
+        t: float/numpy.ndarray
+            Dates
             
         Returns
         -------
-        type: float
-            Discount factor for the selected date
+        type: numpy.ndarray
+            Continuously compounded zero rates
         """
-        return math.exp(-date * 0.01)
+        raise NotImplementedError
         
-    def __getitem__(self,ind):
+    def Discount(self,t):
         """
-        Return a Path instance from the path list
+        Returns the discount factor of each date
         
         Parameters
         ----------
-        ind: int
-            Index of the Path instance
+        t: float/numpy.ndarray
+            Dates
             
         Returns
         -------
-        type: Path  
-            Path at the ind index
+        type: numpy.ndarray
+            Discount factors
         """
-        return self.Paths[ind]
+        t = numpy.asarray(t,dtype=float)
+        return numpy.exp(-self.ZeroRate(t) * t)
         
-    def __iter__(self):
+    def Forward(self,t0,t1):
         """
-        Returns an iterable list of the Path instance
+        Returns the continuously compounded forward rate between two dates
         
         Parameters
         ----------
-        None
-        
+        t0: float/numpy.ndarray
+            Start dates
+        t1: float/numpy.ndarray
+            End dates (greater than the start dates)
+            
         Returns
         -------
-        type: list
-            List of Path instance
+        type: numpy.ndarray
+            Forward rates
+        """
+        t0 = numpy.asarray(t0,dtype=float)
+        t1 = numpy.asarray(t1,dtype=float)
+        return (self.ZeroRate(t1) * t1 - self.ZeroRate(t0) * t0) / (t1 - t0)
+    
+    def Config(self):
+        """
+        Returns the parameters of the curve (see PathCache)
+        """
+        return []
+
+
+class FlatCurve(TermStructure):
+    """
+    Term structure with the same rate for all the maturities
+    """
+    def __init__(self,rate):
+        """
+        Parameters
+        ----------
+        rate: float
+            Continuously compounded risk-free rate
         """
-        for path in self.Paths:
-            yield path
+        self.Rate = rate
         
+    def ZeroRate(self,t):
+        return numpy.full(numpy.shape(t),self.Rate,dtype=float)
+        
+    def Forward(self,t0,t1):
+        return numpy.full(numpy.broadcast(t0,t1).shape,self.Rate,dtype=float)
+        
+    def Config(self):
+        return [self.Rate]
 
-class Option:
+
+class ZeroCurve(TermStructure):
     """
-    Option class
+    Term structure linearly interpolated between zero rates given at a few 
+    maturities, flat before the first and after the last one
     """
-    def __init__(self,payoff,underlying,expiry=None):
+    def __init__(self,times,rates):
         """
         Parameters
         ----------
-        payoff: function(Path -> float)
-            Payoff function
-        underlying: PathGenerator
-            Underlying PathGenerator instance
-        expiry: float (optional)
-            Expiry date (or last expirty date) of the derivative
+        times: array-like
+            Increasing maturities
+        rates: array-like
+            Continuously compounded zero rates of the maturities
         """
-        self.Underlying = underlying
-        self.Payoff = payoff
-        if expiry is None:
-            self.Expiry = underlying.TotalTime
-        else:
-            self.Expiry = expiry
+        self.Times = numpy.asarray(times,dtype=float)
+        self.Rates = numpy.asarray(rates,dtype=float)
+        if self.Times.shape != self.Rates.shape:
+            raise ValueError("The curve needs one rate per maturity")
         
+    def ZeroRate(self,t):
+        return numpy.interp(t,self.Times,self.Rates)
         
-    def _GetValue(self,path):
+    def Config(self):
+        return [self.Times.tolist(),self.Rates.tolist()]
+
+
+class Instrumentation:
+    """
+    Timers and counters of the stages of the pricing pipeline (random draws, 
+    model steps, payoffs, discounting, confidence intervals...). An instance is
+    given to PathGenerator (instrumentation argument) and shared by the options
+    on its paths. Stages are timed once per batch or per call, never per path
+    """
+    Enabled = True
+    
+    def __init__(self,callback=None):
         """
-        Compute the value at expiry date of the option"
+        Parameters
+        ----------
+        callback: function(str, float -> None) (optional)
+            Function called with the name and elapsed time of each timed stage
+        """
+        self.Callback = callback
+        self.Timers = {}
+        self.Counters = {}
+        self._Lock = threading.Lock()
+        
+    def Stage(self,name):
+        """
+        Returns a context manager timing a stage
         
         Parameters
         ----------
-        path: Path
-            Path for which the value should be computed
+        name: str
+            Name of the stage
             
         Returns
         -------
-        type: float
-            Value at expiry
+        type: context manager
         """
-        return self.Payoff(path) * self.Underlying.Discount(self.Expiry)
+        return _Stage(self,name)
         
-    def Price(self,nbootstrap = 1000):
+    def Count(self,name,n=1):
         """
-        Compute the option price using simulations
+        Increment a counter
+        
+        Parameters
+        ----------
+        name: str
+            Name of the counter
+        n: int (optional)
+            Increment (default: 1)
+            
+        Returns
+        -------
+        None
+        """
+        with self._Lock:
+            self.Counters[name] = self.Counters.get(name,0) + n
+            
+    def _Record(self,name,elapsed):
+        """
+        Add the elapsed time of a stage to its timer
+        """
+        with self._Lock:
+            timer = self.Timers.setdefault(name,[0,0.0])
+            timer[0] += 1
+            timer[1] += elapsed
+        if self.Callback is not None:
+            self.Callback(name,elapsed)
+        
+    def Report(self):
+        """
+        Returns the timers and counters
         
         Parameters
         ----------
@@ -302,64 +630,2432 @@ class Option:
         
         Returns
         -------
-        type: float
-            Option price at t = 0
+        type: dict
+            {'Timers': {stage: {'Calls': int, 'Seconds': float}}, 'Counters': 
+            {counter: int}}
         """
-        tmpval = []
-        for path in self.Underlying:
-            tmpval.append(self._GetValue(path))
-        #av = mean(tmpval)
-        #st = (1.0/sqrt(self.Underlying.NPath))*numpy.std(tmpval)
-        #Dirty bootstrap procedure. Fall far from the closed form solution for OTM put
-        #But still better than without actually
-        bootstrap = [mean(sku.resample(tmpval)) for i in range(nbootstrap)]
-        av = mean(bootstrap)
-        st = numpy.std(bootstrap)
-        return [av - 1.96 * st, av ,av + 1.96 * st]
-
-
-#Filled with some data ~ today
-libor = 0.76944/100.0
-S0 = 2267.89
-r = 12.0 * math.log(1+libor/12.0)
-sigma =0.06 #0.1177
-K = 2250.0
-t=1.0/12.0
-nperiod = 1000
-
-npath = 2000
+        with self._Lock:
+            return {'Timers': {name: {'Calls': calls,'Seconds': seconds} for name, (calls, seconds) in self.Timers.items()},
+                    'Counters': dict(self.Counters)}
+                    
+    def Reset(self):
+        """
+        Reset the timers and counters
+        """
+        with self._Lock:
+            self.Timers = {}
+            self.Counters = {}
 
-pg = PathGenerator(npath,t,t/nperiod,'bs',r,sigma)
-pg.GeneratePaths(S0)
 
+class _Stage:
+    """
+    Context manager timing a stage of an Instrumentation instance
+    """
+    __slots__ = ('Owner','Name','Start')
+    
+    def __init__(self,owner,name):
+        self.Owner = owner
+        self.Name = name
+        
+    def __enter__(self):
+        self.Start = time.perf_counter()
+        return self
+        
+    def __exit__(self,*exc):
+        self.Owner._Record(self.Name,time.perf_counter() - self.Start)
+        return False
 
-plainvanillacall = Option(lambda x: max(x.GetLastItem() - K,0),pg)
-plainvanillaput = Option(lambda x: max(K - x.GetLastItem(),0),pg)
 
-print("Call price data: {}".format(plainvanillacall.Price()))
-print("Put price data: {}".format(plainvanillaput.Price()))
+class _NullStage:
+    """
+    Context manager doing nothing (disabled instrumentation)
+    """
+    __slots__ = ()
+    
+    def __enter__(self):
+        return self
+        
+    def __exit__(self,*exc):
+        return False
 
-N = lambda x: scipy.stats.norm.cdf(x)
 
-d1 = (1.0/(sigma *math.sqrt(t))) * (math.log(S0/K)+(r+(sigma**2.0)/2.0)*t)
-d2 = d1 - sigma * math.sqrt(t)
-print("Closed form call: {}".format(S0 * N(d1) - K * math.exp(-r*t) * N(d2)))
-print("Closed form put: {}".format(-S0 * N(-d1) + K * math.exp(-r*t) * N(-d2)))
+class NullInstrumentation(Instrumentation):
+    """
+    Disabled instrumentation: stages and counters are no-ops, so that the 
+    instrumented code runs at full speed
+    """
+    Enabled = False
+    _NullStage = _NullStage()
+    
+    def __init__(self):
+        pass
+        
+    def Stage(self,name):
+        return self._NullStage
+        
+    def Count(self,name,n=1):
+        pass
+        
+    def Report(self):
+        return {'Timers': {},'Counters': {}}
+        
+    def Reset(self):
+        pass
 
-from matplotlib.ticker import FuncFormatter
+#Default (disabled) instrumentation of PathGenerator
+NO_INSTRUMENTATION = NullInstrumentation()
 
-"""
-plt.hist([p.GetLastItem() for p in pg.Paths],bins=10)
 
-def to_percent(y,position):
-    return str(100*y/npath) + '%'
+class PathGenerator:
+    """
+    Class generating Path instances to price derivatives
+    """
+    def __init__(self,nPath,totaltime,deltaT,model, drift, vol,**kwargs):
+        """
+        Parameters
+        ----------
+        nPath: int
+            Number of path to generate
+        totaltime: float
+            Total time of each path
+        deltaT: float
+            Time interval between two periods
+        drift: float/None
+            Drift of the Brownian motion. If None, the forward rates of the 
+            risk-free curve are used (risk-neutral drift)
+        model: str
+            Name of the model to use, registered in MODELS: "black-scholes",
+            "heston" or "local-vol" (see RegisterModel to add new dynamics)
+        vol: float/function
+            Volatility of the Brownian motion (initial volatility for Heston)
+        **kwargs: optional arguments to provide for certain model
+            kappa, theta, xi, rho: float
+                Heston parameters (see HestonModel)
+            lvtimes, lvspots, lvsurface: array-like
+                Local volatility grid (see LocalVolModel)
+            seed: int
+                Seed of the random number generator used when no generator is
+                provided to GeneratePaths (default: None, i.e. fresh entropy)
+            dtype: numpy.dtype
+                Storage type of the path matrix, numpy.float64 or numpy.float32
+                (default: computedtype)
+            computedtype: numpy.dtype
+                Type of the simulation arithmetic (normal shocks and model state),
+                numpy.float64 (default) or numpy.float32. In single precision, 
+                the pricing reductions are still accumulated in double precision
+                (see Option.PrecisionReport for the error made)
+            storage: str
+                'full' (default) to keep every value of every path, 'terminal' to
+                only keep the last value of each path (path-independent payoffs)
+            batchsize: int
+                Number of paths simulated at once. Bounds the memory used by the
+                normal shocks (default: about 2**20 shocks per batch)
+            antithetic: bool
+                If True, paths are generated by antithetic pairs: the path 2i+1 
+                uses the opposite shocks of the path 2i (default: False)
+            sampling: str
+                'pseudo' (default) for pseudo-random shocks, 'sobol' for scrambled
+                Sobol points assigned to the time steps with a Brownian bridge
+            nreplicate: int
+                Number of independently scrambled Sobol replicates, used to compute
+                confidence intervals with the 'sobol' sampling (default: 16). NPath
+                must be nreplicate times a power of 2
+            dates: array-like
+                Increasing observation dates. If provided, the paths are only 
+                computed at t = 0 and at these dates instead of the regular deltaT
+                grid
+            scheme: str
+                'euler' (default) or 'exact' (Black-Scholes-Merton only: exact 
+                log-normal step between two dates, without discretization bias)
+            storenormals: bool
+                If True, the normal shocks are kept in the attribute Normals to
+                revalue the paths with common random numbers (default: False)
+            curve: TermStructure/float
+                Risk-free curve, or flat risk-free rate, used to discount the 
+                payoffs (default: flat 1% rate). The discount factors and forward
+                rates on the date grid are computed once, in the DiscountFactors
+                and ForwardRates attributes
+            instrumentation: Instrumentation
+                Timers and counters of the pipeline, shared with the options on 
+                the paths (default: NO_INSTRUMENTATION, disabled)
+        """
+        self.TotalTime = totaltime
+        self.NPath = nPath
+        self.DeltaT = deltaT
+        self.Scheme = kwargs.get('scheme','euler')
+        self.Curve = kwargs.get('curve',0.01)
+        if not isinstance(self.Curve,TermStructure):
+            self.Curve = FlatCurve(self.Curve)
+        self.Drift = drift
+        dates = kwargs.get('dates')
+        if dates is None:
+            self._SetGrid(numpy.arange(int(totaltime/deltaT)) * deltaT)
+        else:
+            self._SetGrid(numpy.concatenate(([0.0],numpy.asarray(dates,dtype=float))))
+        self.Vol = vol
+        self.Seed = kwargs.get('seed')
+        self.ComputeDType = numpy.dtype(kwargs.get('computedtype',numpy.float64))
+        if self.ComputeDType not in [numpy.float32,numpy.float64]:
+            raise ValueError("Unknown compute type: {}".format(self.ComputeDType))
+        self.DType = numpy.dtype(kwargs.get('dtype',self.ComputeDType))
+        self.Storage = kwargs.get('storage','full')
+        if self.Storage not in ['full','terminal']:
+            raise ValueError("Unknown storage mode: {}".format(self.Storage))
+        self.BatchSize = kwargs.get('batchsize',max(1,2**20 // max(1,self.NPeriod-1)))
+        self.Antithetic = kwargs.get('antithetic',False)
+        if self.Antithetic:
+            #Pairs must not straddle two batches
+            self.BatchSize += self.BatchSize % 2
+        self.Sampling = kwargs.get('sampling','pseudo')
+        if self.Sampling not in ['pseudo','sobol']:
+            raise ValueError("Unknown sampling: {}".format(self.Sampling))
+        self.NReplicate = kwargs.get('nreplicate',16)
+        if self.Sampling == 'sobol':
+            if self.Antithetic:
+                raise ValueError("Antithetic paths are not available with the 'sobol' sampling")
+            #Sobol points keep their balance properties by blocks of 2**k points
+            self.BatchSize = 2 ** int(math.log(self.BatchSize,2))
+        self._Bridge = None
+        self.StoreNormals = kwargs.get('storenormals',False)
+        self.Instrumentation = kwargs.get('instrumentation',NO_INSTRUMENTATION)
+        self.Values = None
+        self.Terminal = None
+        self.Normals = None
+        self.State = None
+        self.SeedSequence = None
+        self.S0 = None
+        #Number of random streams used by the paths, and number of extensions of
+        #the horizon
+        self.NStream = 0
+        self.NExtension = 0
+        #Incremented when the existing paths change (see Option._GetValues)
+        self.Revision = 0
+        
+        if model.lower() not in MODELS:
+            raise ValueError("Unknown model: {}".format(model))
+        self.Dynamics = MODELS[model.lower()](self,**kwargs)
+        self.Model = self.Dynamics.Name
+        if self.Scheme not in ['euler','exact']:
+            raise ValueError("Unknown scheme: {}".format(self.Scheme))
+        if self.Scheme == 'exact' and self.Model != 'bs':
+            raise ValueError("The exact scheme is only available for the Black-Scholes-Merton model")
+            
     
-formatter = FuncFormatter(to_percent)
-plt.gca().yaxis.set_major_formatter(formatter)
-"""
+    def _SetGrid(self,times):
+        """
+        Set the date grid of the paths and the quantities precomputed on it: time
+        steps, discount factors, forward rates and drift of each step
+        
+        Parameters
+        ----------
+        times: numpy.ndarray
+            Increasing dates, starting at t = 0
+            
+        Returns
+        -------
+        None
+        """
+        if numpy.any(numpy.diff(times) <= 0.0):
+            raise ValueError("Observation dates must be positive and increasing")
+        self.Times = times
+        self.NPeriod = times.shape[0]
+        self.Steps = numpy.diff(times)
+        self.DiscountFactors = self.Curve.Discount(times)
+        self.ForwardRates = self.Curve.Forward(times[:-1],times[1:])
+        #Drift of each time step
+        if self.Drift is None:
+            self.StepDrift = self.ForwardRates
+        else:
+            self.StepDrift = numpy.full(self.NPeriod - 1,self.Drift,dtype=float)
+    
+    def _RootSeed(self,rng):
+        """
+        Returns the root seed from which the stream of each batch is spawned
+        
+        Parameters
+        ----------
+        rng: numpy.random.SeedSequence/numpy.random.Generator/int/None
+            Root seed, generator from which the root seed is drawn, or integer seed.
+            If None, the Seed attribute is used
+            
+        Returns
+        -------
+        type: numpy.random.SeedSequence
+            Root seed
+        """
+        if isinstance(rng,numpy.random.SeedSequence):
+            return rng
+        if isinstance(rng,numpy.random.Generator):
+            return numpy.random.SeedSequence(rng.integers(0,2**63,size=4))
+        if rng is None:
+            rng = self.Seed
+        return numpy.random.SeedSequence(rng)
+    
+    def _BatchGenerator(self,root,k,extension=0):
+        """
+        Returns the independent random number generator of the k-th batch. It only
+        depends on the root seed and k, not on the number of workers
+        
+        Parameters
+        ----------
+        root: numpy.random.SeedSequence
+            Root seed
+        k: int
+            Index of the batch
+        extension: int (optional)
+            Index of the horizon extension (default: 0, stream of the paths)
+            
+        Returns
+        -------
+        type: numpy.random.Generator
+            Random number generator of the batch
+        """
+        key = (k,) if extension == 0 else (k,extension)
+        child = numpy.random.SeedSequence(root.entropy,spawn_key=root.spawn_key + key)
+        return numpy.random.default_rng(child)
+    
+    def _DrawNormals(self,n,rng,nstep=None):
+        """
+        Draw in bulk the standard normal shocks of n paths
+        
+        Parameters
+        ----------
+        n: int
+            Number of paths
+        rng: numpy.random.Generator
+            Random number generator
+        nstep: int (optional)
+            Number of time steps (default: NPeriod - 1)
+            
+        Returns
+        -------
+        type: numpy.ndarray
+            Matrix of shape (n, nstep), one column per time step
+        """
+        if self.Antithetic:
+            half = rng.standard_normal(self._NormalShape(n // 2,nstep),dtype=self.ComputeDType)
+            normals = numpy.empty(self._NormalShape(n,nstep),dtype=self.ComputeDType)
+            normals[0::2] = half
+            numpy.negative(half,out=normals[1::2])
+            return normals
+        return rng.standard_normal(self._NormalShape(n,nstep),dtype=self.ComputeDType)
+    
+    def _NormalShape(self,n,nstep=None):
+        """
+        Returns the shape of the normal shocks of n paths: (n, NPeriod - 1), plus a
+        last axis of size NFactors for the multi-factor models
+        """
+        if nstep is None:
+            nstep = self.NPeriod - 1
+        if self.Dynamics.NFactors == 1:
+            return (n,nstep)
+        return (n,nstep,self.Dynamics.NFactors)
+    
+    def _DrawSobolNormals(self,n,offset,rng):
+        """
+        Draw the shocks of n paths from a scrambled Sobol sequence. The first 
+        coordinate of each point sets the terminal value of the Brownian motion, the
+        next ones fill the midpoints (Brownian bridge), so that the most important
+        dimensions of the payoff get the best distributed coordinates
+        
+        Parameters
+        ----------
+        n: int
+            Number of paths
+        offset: int
+            Index of the first point in the Sobol sequence
+        rng: numpy.random.Generator
+            Random number generator of the scrambling (one per replicate)
+            
+        Returns
+        -------
+        type: numpy.ndarray
+            Matrix of shape (n, NPeriod - 1), one column per time step (plus a
+            factor axis for multi-factor models)
+        """
+        import scipy.special
+        import scipy.stats.qmc
+        nfactor = self.Dynamics.NFactors
+        engine = scipy.stats.qmc.Sobol((self.NPeriod - 1) * nfactor,scramble=True,seed=rng)
+        if offset > 0:
+            engine.fast_forward(offset)
+        z = scipy.special.ndtri(engine.random(n))
+        if self._Bridge is None:
+            self._Bridge = BrownianBridge(self.Times)
+        if nfactor == 1:
+            return self._Bridge.Normals(z).astype(self.ComputeDType,copy=False)
+        #The first coordinates drive the terminal values of all the factors
+        normals = numpy.stack([self._Bridge.Normals(z[:,f::nfactor]) for f in range(nfactor)],axis=2)
+        return normals.astype(self.ComputeDType,copy=False)
+    
+    def _Advance(self,s0,normals,values=None,state=None,stateout=None):
+        """
+        Move all the paths forward together, one time step at a time, with the 
+        vectorized step kernel of the model. The shocks drive the last time steps
+        of the grid (all of them, unless the paths are extended from a state)
+        
+        Parameters
+        ----------
+        s0: float
+            Initial value of the random variable
+        normals: numpy.ndarray
+            Standard normal shocks, one row per path and one column per time step
+        values: numpy.ndarray (optional)
+            Matrix of shape (n, number of steps + 1) filled with the value of each 
+            path at each period. If None, only the terminal values are kept
+        state: numpy.ndarray (optional)
+            Initial state of the paths (default: initial state of the model at s0)
+        stateout: numpy.ndarray (optional)
+            Array to fill with the terminal state of the paths
+            
+        Returns
+        -------
+        type: numpy.ndarray
+            Terminal value of each path
+        """
+        model = self.Dynamics
+        self.Instrumentation.Count('Steps',normals.shape[0] * normals.shape[1])
+        with self.Instrumentation.Stage('Advance'):
+            if state is None:
+                state = model.Initial(self,s0,normals.shape[0])
+            if values is not None:
+                values[:,0] = model.Spot(state)
+            first = self.NPeriod - 1 - normals.shape[1]
+            for j in range(normals.shape[1]):
+                state = model.Step(self,state,first + j,normals[:,j],float(self.ForwardRates[first + j]))
+                if values is not None:
+                    values[:,j+1] = model.Spot(state)
+            if stateout is not None:
+                stateout[:] = state
+            return model.Spot(state)
+    
+    def _Batches(self,npath):
+        """
+        Split npath paths in batches of at most BatchSize paths. With the 'sobol'
+        sampling, batches do not straddle two replicates
+        
+        Parameters
+        ----------
+        npath: int
+            Total number of paths
+            
+        Returns
+        -------
+        type: generator
+            (k, start, stop, offset) for each batch: index of the random stream, 
+            row indices of the batch and position of the batch in the stream
+        """
+        if self.Antithetic and npath % 2:
+            raise ValueError("Antithetic paths need an even number of paths")
+        if self.Sampling == 'sobol':
+            m = self._ReplicateSize(npath)
+            for k in range(self.NReplicate):
+                for offset in range(0,m,self.BatchSize):
+                    yield k, k * m + offset, k * m + min(offset + self.BatchSize,m), offset
+        else:
+            for k, start in enumerate(range(0,npath,self.BatchSize)):
+                yield k, start, min(start + self.BatchSize,npath), 0
+    
+    def _ReplicateSize(self,npath):
+        """
+        Returns the number of paths of each randomized QMC replicate
+        """
+        m = npath // self.NReplicate
+        #Sobol points keep their balance properties by blocks of 2**k points
+        if npath % self.NReplicate or m & (m - 1):
+            raise ValueError("The number of paths must be the number of replicates times a power of 2")
+        return m
+    
+    def _SimulateBatch(self,s0,root,k,offset,n,values=None,normalsout=None,stateout=None):
+        """
+        Simulate a batch of paths with its own random stream
+        
+        Parameters
+        ----------
+        s0: float
+            Initial value of the random variable
+        root: numpy.random.SeedSequence
+            Root seed
+        k: int
+            Index of the random stream (batch, or Sobol replicate)
+        offset: int
+            Position of the batch in the stream (Sobol sampling only)
+        n: int
+            Number of paths in the batch
+        values: numpy.ndarray (optional)
+            (n, NPeriod) matrix to fill with the paths. If None, only the terminal
+            values are computed
+        normalsout: numpy.ndarray (optional)
+            (n, NPeriod - 1) matrix to fill with the normal shocks
+        stateout: numpy.ndarray (optional)
+            Array to fill with the terminal state of the paths (multi-factor models)
+            
+        Returns
+        -------
+        type: numpy.ndarray
+            Terminal value of each path of the batch
+        """
+        inst = self.Instrumentation
+        with inst.Stage('Draw'):
+            if self.Sampling == 'sobol':
+                normals = self._DrawSobolNormals(n,offset,self._BatchGenerator(root,k))
+            else:
+                normals = self._DrawNormals(n,self._BatchGenerator(root,k))
+        inst.Count('Batches')
+        inst.Count('Paths',n)
+        inst.Count('BytesAllocated',normals.nbytes)
+        if normalsout is not None:
+            normalsout[:] = normals
+        return self._Advance(s0,normals,values,None,stateout)
+    
+    def _Shell(self):
+        """
+        Returns a copy of the instance without the simulated paths, cheap to send to
+        a worker process
+        """
+        shell = copy.copy(self)
+        shell.Values = None
+        shell.Terminal = None
+        shell.Normals = None
+        shell.State = None
+        return shell
+        
+    def _initPaths(self,s0):
+        """
+        Init the attribute Values as a contiguous (NPath, NPeriod) matrix, one row
+        per path
+        
+        Parameters
+        ----------
+        s0: float
+            Initial value of the random variable
+            
+        Returns
+        -------
+        None
+        """
+        self.Values = numpy.empty((self.NPath,self.NPeriod),dtype=self.DType)
+        self.Values[:,0] = s0
+        
+    def GeneratePaths(self,s0,rng=None,nworkers=1,backend='thread',cache=None):
+        """
+        Generate the Path instance to price derivatives
+        
+        All the normal shocks are drawn in bulk and every path is moved forward 
+        together with the vectorized drift and volatility kernels. Paths are 
+        simulated by batches of BatchSize paths, each batch drawing from its own
+        stream spawned from the root seed. Batches can be spread over several 
+        workers: the paths are bit-identical whatever the number of workers. With
+        the 'terminal' storage, only the attribute Terminal is filled
+        
+        Parameters
+        ----------
+        s0: float
+            Initial value of the random variable
+        rng: numpy.random.SeedSequence/numpy.random.Generator/int (optional)
+            Root seed, seeded random number generator from which the root seed is
+            drawn, or integer seed. Default: the Seed attribute
+        nworkers: int (optional)
+            Number of workers (default: 1, no parallelism)
+        backend: str (optional)
+            'thread' (default) to run the batches in a thread pool (the NumPy 
+            kernels release the GIL), 'process' to run them in a process pool
+        cache: PathCache (optional)
+            Disk cache: if the same paths were already generated, they are 
+            memory-mapped (read-only) from the cache instead of being simulated.
+            Ignored when the paths are not reproducible (no rng and no Seed)
+            
+        Returns
+        -------
+        None
+        """
+        with self.Instrumentation.Stage('GeneratePaths'):
+            self._GeneratePaths(s0,rng,nworkers,backend,cache)
+        
+    def _GeneratePaths(self,s0,rng,nworkers,backend,cache):
+        """
+        Generate the paths, see GeneratePaths
+        """
+        root = self._RootSeed(rng)
+        self.SeedSequence = root
+        self.S0 = s0
+        self.Revision += 1
+        self.NExtension = 0
+        batches = list(self._Batches(self.NPath))
+        self.NStream = max(k for k, start, stop, offset in batches) + 1
+        self.State = None
+        #Paths drawn from fresh entropy can never be requested again: not cached
+        if rng is None and self.Seed is None:
+            cache = None
+        if cache is not None:
+            key = cache.Key(self,s0,root)
+            if cache.Load(self,key):
+                return
+        if self.Storage == 'terminal':
+            self.Values = None
+            self.Terminal = numpy.empty(self.NPath,dtype=self.DType)
+        else:
+            self._initPaths(s0)
+            self.Terminal = None
+        self.Normals = numpy.empty(self._NormalShape(self.NPath),dtype=self.ComputeDType) if self.StoreNormals else None
+        if self.Dynamics.NFactors > 1:
+            self.State = numpy.empty((self.NPath,self.Dynamics.NFactors),dtype=self.ComputeDType)
+        self.Instrumentation.Count('BytesAllocated',sum(a.nbytes for a in [self.Values,self.Terminal,self.Normals,self.State] if a is not None))
+        self._RunBatches(s0,root,batches,self.Values,self.Terminal,self.Normals,self.State,nworkers,backend)
+        if cache is not None:
+            cache.Save(self,key)
+            
+    def _RunBatches(self,s0,root,batches,values,terminal,normals,state,nworkers,backend):
+        """
+        Simulate batches of paths, sequentially or in a pool of workers, and write
+        them in the output arrays
+        
+        Parameters
+        ----------
+        s0: float
+            Initial value of the random variable
+        root: numpy.random.SeedSequence
+            Root seed
+        batches: list
+            (k, start, stop, offset) for each batch (see _Batches), the rows being
+            those of the output arrays
+        values: numpy.ndarray/None
+            Path matrix to fill ('full' storage)
+        terminal: numpy.ndarray/None
+            Terminal values to fill ('terminal' storage)
+        normals: numpy.ndarray/None
+            Normal shocks to fill
+        state: numpy.ndarray/None
+            Terminal states to fill (multi-factor models)
+        nworkers: int
+            Number of workers
+        backend: str
+            'thread' or 'process'
+            
+        Returns
+        -------
+        None
+        """
+        def rows(a,start,stop):
+            return None if a is None else a[start:stop]
+        
+        def run(batch):
+            k, start, stop, offset = batch
+            result = self._SimulateBatch(s0,root,k,offset,stop - start,rows(values,start,stop),
+                                         rows(normals,start,stop),rows(state,start,stop))
+            if terminal is not None:
+                terminal[start:stop] = result
+        
+        if nworkers <= 1 or len(batches) <= 1:
+            for batch in batches:
+                run(batch)
+        elif backend == 'thread':
+            with concurrent.futures.ThreadPoolExecutor(nworkers) as executor:
+                list(executor.map(run,batches))
+        elif backend == 'process':
+            shell = self._Shell()
+            #Stages run in the workers are not timed
+            shell.Instrumentation = NO_INSTRUMENTATION
+            full = values is not None
+            with concurrent.futures.ProcessPoolExecutor(nworkers) as executor:
+                futures = [executor.submit(_GenerateBatch,shell,s0,root,k,offset,stop - start,full) for k, start, stop, offset in batches]
+                for future, (k, start, stop, offset) in zip(futures,batches):
+                    result, batchnormals, batchstate = future.result()
+                    if full:
+                        values[start:stop] = result
+                    else:
+                        terminal[start:stop] = result
+                    if normals is not None:
+                        normals[start:stop] = batchnormals
+                    if state is not None:
+                        state[start:stop] = batchstate
+        else:
+            raise ValueError("Unknown backend: {}".format(backend))
+            
+    def _CheckIncremental(self):
+        """
+        Raise an error if the paths cannot be extended
+        """
+        if self.SeedSequence is None:
+            raise ValueError("The paths must be generated first")
+        if self.Sampling == 'sobol':
+            raise ValueError("Incremental paths need the 'pseudo' sampling")
+        if self.Dynamics.NFactors > 1 and self.State is None:
+            raise ValueError("The terminal state of the paths is not available (paths loaded from a cache)")
+        #Read-only memory maps of a PathCache are copied
+        if self.Values is not None and not self.Values.flags.writeable:
+            self.Values = numpy.array(self.Values)
+        if self.Terminal is not None and not self.Terminal.flags.writeable:
+            self.Terminal = numpy.array(self.Terminal)
+        if self.Normals is not None and not self.Normals.flags.writeable:
+            self.Normals = numpy.array(self.Normals)
+        
+    def AddPaths(self,npath,nworkers=1,backend='thread'):
+        """
+        Append npath new paths to the generated ones. The new paths draw from the 
+        next random streams of the root seed: the existing paths are kept and the
+        new ones are independent from them. They are simulated on the current 
+        (possibly extended) date grid
+        
+        Parameters
+        ----------
+        npath: int
+            Number of paths to add
+        nworkers: int (optional)
+            Number of workers (default: 1, no parallelism)
+        backend: str (optional)
+            'thread' (default) or 'process', see GeneratePaths
+            
+        Returns
+        -------
+        None
+        """
+        self._CheckIncremental()
+        nfactor = self.Dynamics.NFactors
+        values = numpy.empty((npath,self.NPeriod),dtype=self.DType) if self.Storage == 'full' else None
+        terminal = numpy.empty(npath,dtype=self.DType) if self.Storage == 'terminal' else None
+        normals = numpy.empty(self._NormalShape(npath),dtype=self.ComputeDType) if self.StoreNormals else None
+        state = numpy.empty((npath,nfactor),dtype=self.ComputeDType) if nfactor > 1 else None
+        batches = [(self.NStream + k,start,stop,offset) for k, start, stop, offset in self._Batches(npath)]
+        self._RunBatches(self.S0,self.SeedSequence,batches,values,terminal,normals,state,nworkers,backend)
+        self.NStream += len(batches)
+        self.NPath += npath
+        if values is not None:
+            self.Values = numpy.concatenate((self.Values,values))
+        else:
+            self.Terminal = numpy.concatenate((self.Terminal,terminal))
+        if normals is not None:
+            self.Normals = numpy.concatenate((self.Normals,normals))
+        if state is not None:
+            self.State = numpy.concatenate((self.State,state))
+    
+    def ExtendHorizon(self,totaltime=None,dates=None):
+        """
+        Extend every path forward in time from its last value (last state for the
+        multi-factor models). The shocks of each extension are drawn from their own
+        streams of the root seed, batch by batch, so the existing values are kept.
+        Options created before the extension keep their expiry: they are valued on
+        the dates of the paths up to their Horizon attribute
+        
+        Parameters
+        ----------
+        totaltime: float (optional)
+            New total time, the new dates following the deltaT grid
+        dates: array-like (optional)
+            New observation dates, increasing and after the last date
+            
+        Returns
+        -------
+        None
+        """
+        self._CheckIncremental()
+        if dates is None:
+            if totaltime is None:
+                raise ValueError("A new total time or new dates must be provided")
+            grid = numpy.arange(int(totaltime/self.DeltaT)) * self.DeltaT
+            dates = grid[grid > self.Times[-1]]
+        dates = numpy.asarray(dates,dtype=float)
+        if dates.shape[0] == 0:
+            return
+        nold = self.NPeriod
+        self._SetGrid(numpy.concatenate((self.Times,dates)))
+        self.TotalTime = totaltime if totaltime is not None else dates[-1]
+        self.Dynamics.Grid(self)
+        self.NExtension += 1
+        self.Revision += 1
+        nstep = dates.shape[0]
+        if self.Storage == 'full':
+            values = numpy.empty((self.NPath,self.NPeriod),dtype=self.DType)
+            values[:,:nold] = self.Values
+            self.Values = values
+        if self.StoreNormals:
+            normals = numpy.empty(self._NormalShape(self.NPath),dtype=self.ComputeDType)
+            normals[:,:nold - 1] = self.Normals
+            self.Normals = normals
+        for k, start, stop, offset in self._Batches(self.NPath):
+            with self.Instrumentation.Stage('Draw'):
+                z = self._DrawNormals(stop - start,self._BatchGenerator(self.SeedSequence,k,self.NExtension),nstep)
+            if self.StoreNormals:
+                self.Normals[start:stop,nold - 1:] = z
+            stateout = None
+            if self.State is not None:
+                state = stateout = self.State[start:stop]
+            elif self.Storage == 'full':
+                state = self.Values[start:stop,nold - 1].astype(self.ComputeDType)
+            else:
+                state = self.Terminal[start:stop].astype(self.ComputeDType)
+            if self.Storage == 'full':
+                self._Advance(None,z,self.Values[start:stop,nold - 1:],state,stateout)
+            else:
+                self.Terminal[start:stop] = self._Advance(None,z,None,state,stateout)
+    
+    def _Config(self):
+        """
+        Returns the parameters that determine the generated paths, for a given 
+        initial value and root seed (see PathCache)
+        """
+        return [self.Model,repr(self.Drift),repr(self.Vol),self.NPath,self.Times.tolist(),
+                self.Scheme,self.Sampling,self.NReplicate,self.Antithetic,self.BatchSize,
+                self.DType.str,self.ComputeDType.str,self.Storage,self.StoreNormals,self.Dynamics.Config(),
+                type(self.Curve).__name__,self.Curve.Config()]
+    
+    def IterBatches(self,s0,rng=None,npath=None):
+        """
+        Generate paths batch by batch without storing them. Memory stays constant
+        whatever the number of paths
+        
+        Parameters
+        ----------
+        s0: float
+            Initial value of the random variable
+        rng: numpy.random.SeedSequence/numpy.random.Generator/int (optional)
+            Root seed, seeded random number generator from which the root seed is
+            drawn, or integer seed. Default: the Seed attribute
+        npath: int (optional)
+            Number of paths to generate (default: NPath)
+            
+        Returns
+        -------
+        type: generator
+            numpy.ndarray of terminal values ('terminal' storage) or 
+            (batch size, NPeriod) path matrix ('full' storage) for each batch
+        """
+        root = self._RootSeed(rng)
+        if npath is None:
+            npath = self.NPath
+        for k, start, stop, offset in self._Batches(npath):
+            if self.Storage == 'terminal':
+                yield self._SimulateBatch(s0,root,k,offset,stop - start).astype(self.DType,copy=False)
+            else:
+                values = numpy.empty((stop - start,self.NPeriod),dtype=self.DType)
+                self._SimulateBatch(s0,root,k,offset,stop - start,values)
+                yield values
+    
+    @property
+    def Paths(self):
+        """
+        List of Path instances, each one being a view on a row of the path matrix
+        """
+        self._CheckFullStorage()
+        return list(self)
+    
+    def ExpectedTerminal(self,s0=None):
+        """
+        Returns the expectation of the last value of the paths, known in closed form
+        for all the models. Used as a control variate
+        
+        Parameters
+        ----------
+        s0: float (optional)
+            Initial value of the random variable (default: the one of the last 
+            generated paths)
+            
+        Returns
+        -------
+        type: float
+            Expected terminal value
+        """
+        if s0 is None:
+            s0 = self.S0
+        if self.Scheme == 'exact' or self.Model != 'bs':
+            #Log-Euler steps of the stochastic/local volatility models are martingales
+            return s0 * math.exp(numpy.dot(self.StepDrift,self.Steps))
+        #Exact for the Euler scheme: E[S(t+dt)] = (1 + drift * dt) * E[S(t)]
+        return s0 * numpy.prod(1.0 + self.StepDrift * self.Steps)
+    
+    def _HasShocks(self):
+        """
+        Returns True if the normal shocks of the paths are available: stored, or 
+        recoverable from the values of the Black-Scholes-Merton paths (see _Shocks)
+        """
+        if self.Normals is not None:
+            return True
+        return self.Model == 'bs' and (self.Storage == 'full' or self.Scheme == 'exact')
+    
+    def _Shocks(self):
+        """
+        Returns the normal shocks of the paths: the Normals attribute if they were 
+        stored, else inverted from the Black-Scholes-Merton steps of the path 
+        matrix. With the 'terminal' storage and the exact scheme, shocks giving the
+        same terminal values are returned (only the terminal Brownian value is 
+        known)
+        
+        Parameters
+        ----------
+        None
+        
+        Returns
+        -------
+        type: numpy.ndarray
+            (NPath, NPeriod - 1) standard normal shocks
+        """
+        if self.Normals is not None:
+            return self.Normals
+        if not self._HasShocks():
+            raise ValueError("The normal shocks are needed: use storenormals=True")
+        sqrtdt = numpy.sqrt(self.Steps)
+        if self.Storage == 'terminal':
+            #Sum of sqrt(dt) * z equal to the terminal Brownian value
+            return self.TerminalBrownian()[:,None] * (sqrtdt / self.Times[-1])[None,:]
+        values = numpy.asarray(self.Values,dtype=float)
+        ratio = values[:,1:] / values[:,:-1]
+        if self.Scheme == 'exact':
+            return (numpy.log(ratio) - (self.StepDrift - 0.5 * self.Vol ** 2) * self.Steps) / (self.Vol * sqrtdt)
+        return (ratio - 1.0 - self.StepDrift * self.Steps) / (self.Vol * sqrtdt)
+    
+    def TerminalBrownian(self):
+        """
+        Returns the value at the last date of the Brownian motion driving each path.
+        Recovered from the terminal values with the exact scheme, from the normal 
+        shocks otherwise (see _Shocks)
+        
+        Parameters
+        ----------
+        None
+        
+        Returns
+        -------
+        type: numpy.ndarray
+            Terminal value of the Brownian motion of each path
+        """
+        if self.Scheme == 'exact':
+            logret = numpy.log(numpy.asarray(self.GetLastItems(),dtype=float) / self.S0)
+            return (logret - numpy.dot(self.StepDrift,self.Steps) + 0.5 * self.Vol ** 2 * self.Times[-1]) / self.Vol
+        return numpy.dot(self._Shocks(),numpy.sqrt(self.Steps))
+    
+    def VolSensitivity(self):
+        """
+        Returns the pathwise derivative of the terminal value of each path with 
+        respect to the volatility (Black-Scholes-Merton model)
+        
+        Parameters
+        ----------
+        None
+        
+        Returns
+        -------
+        type: numpy.ndarray
+            dS(T)/dsigma for each path
+        """
+        terminal = numpy.asarray(self.GetLastItems(),dtype=float)
+        if self.Scheme == 'exact':
+            return terminal * (self.TerminalBrownian() - self.Vol * self.Times[-1])
+        #Derivative of the log of the product of the Euler factors
+        dW = self._Shocks() * numpy.sqrt(self.Steps)
+        return terminal * (dW / (1.0 + self.StepDrift * self.Steps + self.Vol * dW)).sum(axis=1)
+    
+    def Revalue(self,s0=None,vol=None):
+        """
+        Recompute the paths with other parameters and the same normal shocks 
+        (common random numbers, see _Shocks)
+        
+        Parameters
+        ----------
+        s0: float (optional)
+            Initial value (default: the one of the generated paths)
+        vol: float (optional)
+            Volatility (default: Vol attribute)
+            
+        Returns
+        -------
+        type: tuple
+            (path matrix or None with the 'terminal' storage, terminal values)
+        """
+        normals = self._Shocks()
+        shell = self._Shell()
+        if vol is not None:
+            shell.Vol = vol
+        if s0 is None:
+            s0 = self.S0
+        values = None
+        if self.Storage == 'full':
+            values = numpy.empty((self.NPath,self.NPeriod),dtype=self.DType)
+        terminal = shell._Advance(s0,normals,values)
+        return values, terminal
+    
+    def IndependentSamples(self,values):
+        """
+        Returns the independent samples of per-path values: the average of each
+        antithetic pair, the average of each Sobol replicate, or the values 
+        themselves
+        
+        Parameters
+        ----------
+        values: numpy.ndarray
+            One value (or one row of values) per path, in the path order
+            
+        Returns
+        -------
+        type: numpy.ndarray
+            Independent samples with the same expectation as the values
+        """
+        if self.Antithetic:
+            return values.reshape((-1,2) + values.shape[1:]).mean(axis=1)
+        if self.Sampling == 'sobol':
+            return values.reshape((self.NReplicate,-1) + values.shape[1:]).mean(axis=1)
+        return values
+    
+    def DefaultIntervalMethod(self,method):
+        """
+        Returns the confidence interval method to use. Randomized QMC only provides
+        a few independent replicates: the bootstrap is replaced by the analytic 
+        standard error
+        
+        Parameters
+        ----------
+        method: str
+            Requested method ('bootstrap', 'analytic' or 'auto')
+            
+        Returns
+        -------
+        type: str
+            Method to use
+        """
+        if method == 'auto' and self.Sampling == 'sobol':
+            return 'analytic'
+        return method
+    
+    def GetLastItems(self):
+        """
+        Returns the last value of every path
+        
+        Parameters
+        ----------
+        None
+        
+        Returns
+        -------
+        type: numpy.ndarray
+            View on the last column of the path matrix (or the Terminal attribute
+            with the 'terminal' storage)
+        """
+        if self.Storage == 'terminal':
+            return self.Terminal
+        return self.Values[:,self.NPeriod-1]
+    
+    def GetItemsByDate(self,dates,values=None):
+        """
+        Return the value of every path at given dates, linearly interpolated 
+        between the two closest periods
+        
+        Parameters
+        ----------
+        dates: float/array-like
+            Dates for which the values should be returned
+        values: numpy.ndarray (optional)
+            (n, NPeriod) path matrix (default: the Values attribute)
+            
+        Returns
+        -------
+        type: numpy.ndarray
+            (NPath,) values for a single date, (NPath, len(dates)) otherwise
+        """
+        d = numpy.asarray(dates,dtype=float)
+        flat = numpy.atleast_1d(d)
+        if values is None and self.Storage == 'terminal':
+            if numpy.any(flat != self.Times[-1]):
+                raise ValueError("Only the last date is available with the 'terminal' storage")
+            result = numpy.repeat(self.Terminal[:,None],flat.shape[0],axis=1)
+        else:
+            ind = numpy.clip(numpy.searchsorted(self.Times,flat,side='right') - 1,0,self.NPeriod - 2)
+            w = numpy.clip((flat - self.Times[ind]) / self.Steps[ind],0.0,1.0)
+            if values is None:
+                values = self.Values
+            result = values[:,ind] * (1.0 - w) + values[:,ind + 1] * w
+        return result[:,0] if d.ndim == 0 else result
+                
+    def Discount(self,date):
+        """
+        Returns the discount factor for a given date (or array of dates). Dates of
+        the simulation grid are read from the DiscountFactors attribute
+        
+        Parameters
+        ----------
+        date: float/array-like
+            Date(s) of the cash flow
+            
+        Returns
+        -------
+        type: float/numpy.ndarray
+            Discount factor(s) for the selected date(s)
+        """
+        d = numpy.asarray(date,dtype=float)
+        ind = numpy.clip(numpy.searchsorted(self.Times,d),0,self.NPeriod - 1)
+        if numpy.all(self.Times[ind] == d):
+            df = self.DiscountFactors[ind]
+        else:
+            df = self.Curve.Discount(d)
+        return float(df) if d.ndim == 0 else df
+        
+    def __getitem__(self,ind):
+        """
+        Return a Path instance from the path list
+        
+        Parameters
+        ----------
+        ind: int
+            Index of the Path instance
+            
+        Returns
+        -------
+        type: Path  
+            Path at the ind index
+        """
+        self._CheckFullStorage()
+        return Path(None,self.NPeriod,self.DeltaT,self.Values[ind],self.Times)
+    
+    def _CheckFullStorage(self):
+        """
+        Raise a ValueError if the path matrix is not kept ('terminal' storage)
+        """
+        if self.Storage == 'terminal':
+            raise ValueError("Path instances need the 'full' path storage")
+        
+    def __len__(self):
+        """
+        Returns the number of paths
+        """
+        return self.NPath
+        
+    def __iter__(self):
+        """
+        Returns an iterable list of the Path instance
+        
+        Parameters
+        ----------
+        None
+        
+        Returns
+        -------
+        type: list
+            List of Path instance
+        """
+        self._CheckFullStorage()
+        for row in self.Values:
+            yield Path(None,self.NPeriod,self.DeltaT,row,self.Times)
+        
+
+class PathCache:
+    """
+    Disk cache of generated paths. Path matrices are saved as .npy files keyed by a
+    hash of the PathGenerator configuration, initial value and seed, and memory 
+    mapped back on later runs. The least recently used files are evicted when the
+    cache exceeds its size
+    """
+    Version = 1
+    
+    def __init__(self,directory,maxbytes=2**32):
+        """
+        Parameters
+        ----------
+        directory: str
+            Directory of the cache (created if needed)
+        maxbytes: int (optional)
+            Maximum size of the cache on disk (default: 4 GiB)
+        """
+        self.Directory = directory
+        self.MaxBytes = maxbytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    
+    def Key(self,generator,s0,root):
+        """
+        Returns the cache key of a simulation
+        
+        Parameters
+        ----------
+        generator: PathGenerator
+            PathGenerator instance
+        s0: float
+            Initial value of the random variable
+        root: numpy.random.SeedSequence
+            Root seed of the simulation
+            
+        Returns
+        -------
+        type: str
+            Hexadecimal key
+        """
+        config = [self.Version,float(s0),str(root.entropy),list(root.spawn_key)] + generator._Config()
+        return hashlib.sha256(json.dumps(config).encode('utf-8')).hexdigest()
+    
+    def _Files(self,key):
+        """
+        Returns the path of the files of a key: paths (or terminal values) and 
+        normal shocks
+        """
+        base = os.path.join(self.Directory,key)
+        return base + '.npy', base + '.normals.npy'
+    
+    def Load(self,generator,key):
+        """
+        Memory-map cached paths into a PathGenerator
+        
+        Parameters
+        ----------
+        generator: PathGenerator
+            PathGenerator instance to fill
+        key: str
+            Cache key
+            
+        Returns
+        -------
+        type: bool
+            True if the paths were found in the cache
+        """
+        pathfile, normalfile = self._Files(key)
+        if not os.path.exists(pathfile) or (generator.StoreNormals and not os.path.exists(normalfile)):
+            return False
+        values = numpy.load(pathfile,mmap_mode='r')
+        if generator.Storage == 'terminal':
+            generator.Values, generator.Terminal = None, values
+        else:
+            generator.Values, generator.Terminal = values, None
+        generator.Normals = numpy.load(normalfile,mmap_mode='r') if generator.StoreNormals else None
+        #Access time drives the eviction
+        os.utime(pathfile,None)
+        return True
+    
+    def Save(self,generator,key):
+        """
+        Save the paths of a PathGenerator in the cache, then evict the least 
+        recently used entries if the cache is too large
+        
+        Parameters
+        ----------
+        generator: PathGenerator
+            PathGenerator instance with generated paths
+        key: str
+            Cache key
+            
+        Returns
+        -------
+        None
+        """
+        pathfile, normalfile = self._Files(key)
+        values = generator.Terminal if generator.Storage == 'terminal' else generator.Values
+        if generator.StoreNormals:
+            self._Write(normalfile,generator.Normals)
+        self._Write(pathfile,values)
+        self.Evict()
+    
+    def _Write(self,filename,array):
+        """
+        Write an array atomically (concurrent readers never see a partial file)
+        """
+        tmp = filename + '.{}.tmp'.format(os.getpid())
+        with open(tmp,'wb') as f:
+            numpy.save(f,array)
+        os.replace(tmp,filename)
+    
+    def Evict(self):
+        """
+        Remove the least recently used entries until the cache fits in MaxBytes
+        
+        Parameters
+        ----------
+        None
+        
+        Returns
+        -------
+        None
+        """
+        entries = {}
+        for name in os.listdir(self.Directory):
+            if not name.endswith('.npy'):
+                continue
+            key = name.split('.')[0]
+            stat = os.stat(os.path.join(self.Directory,name))
+            size, used = entries.get(key,(0,0.0))
+            entries[key] = (size + stat.st_size,max(used,stat.st_mtime))
+        total = sum(size for size, used in entries.values())
+        for key in sorted(entries,key=lambda k: entries[k][1]):
+            if total <= self.MaxBytes:
+                break
+            for filename in self._Files(key):
+                if os.path.exists(filename):
+                    os.remove(filename)
+            total -= entries[key][0]
+
+
+def _GenerateBatch(generator,s0,root,k,offset,n,full):
+    """
+    Simulate the k-th batch of paths of a PathGenerator in a worker process
+    
+    Parameters
+    ----------
+    generator: PathGenerator
+        PathGenerator instance without simulated paths (see PathGenerator._Shell)
+    s0: float
+        Initial value of the random variable
+    root: numpy.random.SeedSequence
+        Root seed
+    k: int
+        Index of the random stream
+    offset: int
+        Position of the batch in the stream
+    n: int
+        Number of paths in the batch
+    full: bool
+        True to return the whole paths, False to only return the terminal values
+        
+    Returns
+    -------
+    type: tuple
+        (n, NPeriod) path matrix or terminal values of the batch, normal shocks
+        of the batch (None if the generator does not store them) and terminal 
+        states (None for the one-factor models)
+    """
+    normals = numpy.empty(generator._NormalShape(n),dtype=generator.ComputeDType) if generator.StoreNormals else None
+    nfactor = generator.Dynamics.NFactors
+    state = numpy.empty((n,nfactor),dtype=generator.ComputeDType) if nfactor > 1 else None
+    if full:
+        values = numpy.empty((n,generator.NPeriod),dtype=generator.DType)
+        generator._SimulateBatch(s0,root,k,offset,n,values,normals,state)
+        return values, normals, state
+    return generator._SimulateBatch(s0,root,k,offset,n,None,normals,state), normals, state
+
+
+class BrownianBridge:
+    """
+    Brownian bridge construction of a Brownian motion on a time grid: the terminal
+    value is set first, then the midpoints of the intervals, coarsest first
+    """
+    def __init__(self,times):
+        """
+        Parameters
+        ----------
+        times: array-like
+            Increasing time grid, starting at 0
+        """
+        self.Times = numpy.asarray(times,dtype=float)
+        n = self.Times.shape[0] - 1
+        left, mid, right = [], [], []
+        intervals = [(0,n)]
+        #Breadth-first bisection of the index intervals
+        while intervals:
+            nextintervals = []
+            for l, r in intervals:
+                if r - l < 2:
+                    continue
+                m = (l + r) // 2
+                left.append(l)
+                mid.append(m)
+                right.append(r)
+                nextintervals += [(l,m),(m,r)]
+            intervals = nextintervals
+        self.Left = numpy.array(left,dtype=int)
+        self.Mid = numpy.array(mid,dtype=int)
+        self.Right = numpy.array(right,dtype=int)
+        t = self.Times
+        span = t[self.Right] - t[self.Left]
+        self.LeftWeight = (t[self.Right] - t[self.Mid]) / span
+        self.RightWeight = (t[self.Mid] - t[self.Left]) / span
+        self.StdDev = numpy.sqrt((t[self.Mid] - t[self.Left]) * (t[self.Right] - t[self.Mid]) / span)
+        
+    def Normals(self,z):
+        """
+        Build the Brownian motions from independent standard normals and returns 
+        their standardized increments
+        
+        Parameters
+        ----------
+        z: numpy.ndarray
+            (n, len(Times) - 1) standard normals, in order of importance
+            
+        Returns
+        -------
+        type: numpy.ndarray
+            (n, len(Times) - 1) standard normal increments, one column per time step
+        """
+        n = self.Times.shape[0] - 1
+        w = numpy.zeros((z.shape[0],n + 1))
+        w[:,n] = math.sqrt(self.Times[n] - self.Times[0]) * z[:,0]
+        for i in range(self.Mid.shape[0]):
+            w[:,self.Mid[i]] = (self.LeftWeight[i] * w[:,self.Left[i]] + self.RightWeight[i] * w[:,self.Right[i]]
+                                + self.StdDev[i] * z[:,i+1])
+        return numpy.diff(w,axis=1) / numpy.sqrt(numpy.diff(self.Times))
+
+
+class Option:
+    """
+    Option class
+    
+    The payoff is evaluated on the paths up to the last date of the underlying 
+    when the option is created (Horizon attribute). If the horizon of the 
+    underlying is extended later (PathGenerator.ExtendHorizon), the option is 
+    still valued at this date, which needs the 'full' storage; the 'underlying'
+    control variate and the pathwise and likelihood ratio Greeks are then not 
+    available
+    """
+    def __init__(self,payoff,underlying,expiry=None,payofftype='path'):
+        """
+        Parameters
+        ----------
+        payoff: function(Path -> float) or function(numpy.ndarray -> numpy.ndarray)
+            Payoff function
+        underlying: PathGenerator
+            Underlying PathGenerator instance
+        expiry: float (optional)
+            Expiry date (or last expirty date) of the derivative
+        payofftype: str (optional)
+            'path' (default) if the payoff is called once per Path instance, 
+            'matrix' if the payoff takes the whole (NPath, NPeriod) path matrix
+            and returns the array of payoffs, 'terminal' if the payoff only takes
+            the array of terminal values (path-independent payoffs)
+        """
+        if payofftype not in ['path','matrix','terminal']:
+            raise ValueError("Unknown payoff type: {}".format(payofftype))
+        self.Underlying = underlying
+        self.Payoff = payoff
+        self.PayoffType = payofftype
+        if expiry is None:
+            self.Expiry = underlying.TotalTime
+        else:
+            self.Expiry = expiry
+        #Last date of the paths on which the payoff is evaluated
+        self.Horizon = underlying.Times[-1]
+        self.Diagnostics = {}
+        #Discounted payoffs of the first paths, and revision of the underlying 
+        #paths they were computed on
+        self._Values = None
+        self._Revision = None
+        
+        
+    def _GetValue(self,path):
+        """
+        Compute the value at expiry date of the option"
+        
+        Parameters
+        ----------
+        path: Path
+            Path for which the value should be computed
+            
+        Returns
+        -------
+        type: float
+            Value at expiry
+        """
+        return self.Payoff(path) * self.Underlying.Discount(self.Expiry)
+    
+    def _GetValues(self):
+        """
+        Compute the value at expiry date of the option for every path. The values
+        are cached: only the paths added since the last call (PathGenerator.AddPaths)
+        are valued
+        
+        Parameters
+        ----------
+        None
+        
+        Returns
+        -------
+        type: numpy.ndarray
+            Discounted payoff of each path
+        """
+        u = self.Underlying
+        if self._Revision != u.Revision or self._Values.shape[0] > u.NPath:
+            self._Values = self._GetBatchValues(u.Values,u.GetLastItems())
+            self._Revision = u.Revision
+        elif self._Values.shape[0] < u.NPath:
+            #Only the paths added since the last call are valued
+            n = self._Values.shape[0]
+            values = None if u.Values is None else u.Values[n:]
+            self._Values = numpy.concatenate((self._Values,self._GetBatchValues(values,u.GetLastItems()[n:])))
+        return self._Values
+    
+    def _HorizonColumns(self):
+        """
+        Returns the number of dates of the underlying up to the Horizon attribute
+        """
+        return int(numpy.searchsorted(self.Underlying.Times,self.Horizon,'right'))
+    
+    def _CheckHorizon(self,feature):
+        """
+        Raise a ValueError if the underlying was extended after the option was 
+        created
+        """
+        if self._HorizonColumns() < self.Underlying.NPeriod:
+            raise ValueError("{} is not available: the horizon of the underlying was extended after the option was created".format(feature))
+        
+    def _GetBatchValues(self,values,terminal):
+        """
+        Compute the value at expiry date of the option for a batch of paths
+        
+        Parameters
+        ----------
+        values: numpy.ndarray/None
+            (n, NPeriod) path matrix of the batch (None with the 'terminal' storage)
+        terminal: numpy.ndarray
+            Terminal values of the batch
+            
+        Returns
+        -------
+        type: numpy.ndarray
+            Discounted payoff of each path of the batch
+        """
+        u = self.Underlying
+        inst = u.Instrumentation
+        if self.PayoffType != 'terminal' and values is None:
+            raise ValueError("Payoff type '{}' needs the 'full' path storage".format(self.PayoffType))
+        ncol = self._HorizonColumns()
+        if ncol < u.NPeriod:
+            #The underlying was extended: the option is valued at its own horizon
+            if values is None:
+                raise ValueError("The 'terminal' storage does not keep the values at the horizon of the option")
+            values = values[:,:ncol]
+            terminal = values[:,-1]
+        inst.Count('PayoffEvaluations',terminal.shape[0])
+        with inst.Stage('Payoff'):
+            if self.PayoffType == 'terminal':
+                payoffs = self.Payoff(numpy.asarray(terminal,dtype=numpy.float64))
+            elif self.PayoffType == 'matrix':
+                payoffs = self.Payoff(values)
+            else:
+                payoffs = [self.Payoff(Path(None,values.shape[1],u.DeltaT,row,u.Times[:values.shape[1]])) for row in values]
+            payoffs = numpy.asarray(payoffs,dtype=float)
+        with inst.Stage('Discount'):
+            return payoffs * u.Discount(self.Expiry)
+        
+    def _GetControl(self,control):
+        """
+        Returns the per-path values of a control variate and their known expectation
+        
+        Parameters
+        ----------
+        control: str/tuple
+            'underlying' for the discounted terminal value of the underlying, or
+            (Option, float) for an option on the same underlying whose price is
+            known in closed form (e.g. a Black-Scholes vanilla)
+            
+        Returns
+        -------
+        type: tuple
+            (numpy.ndarray, float) control values and expectation
+        """
+        if control == 'underlying':
+            self._CheckHorizon("The 'underlying' control variate")
+            df = self.Underlying.Discount(self.Expiry)
+            return self.Underlying.GetLastItems() * df, self.Underlying.ExpectedTerminal() * df
+        option, expectation = control
+        return option._GetValues(), expectation
+    
+    def _GetSamples(self,control=None):
+        """
+        Compute the independent samples of the discounted payoff, after variance
+        reduction. The Diagnostics attribute is updated with the variance per path
+        before and after variance reduction
+        
+        Parameters
+        ----------
+        control: str/tuple (optional)
+            Control variate, see _GetControl (default: None, no control variate)
+            
+        Returns
+        -------
+        type: numpy.ndarray
+            Independent samples of the option value at t = 0
+        """
+        values = self._GetValues()
+        rawvar = numpy.var(values)
+        beta = 0.0
+        samples = self.Underlying.IndependentSamples(values)
+        if control is not None:
+            #Beta is fitted on the independent samples (e.g. antithetic pair means),
+            #whose variance is the one of the estimator
+            cvalues, cexp = self._GetControl(control)
+            csamples = self.Underlying.IndependentSamples(cvalues)
+            if samples.shape[0] > 1:
+                cov = numpy.cov(samples,csamples)
+                if cov[1,1] > 0.0:
+                    beta = cov[0,1] / cov[1,1]
+            samples = samples - beta * (csamples - cexp)
+        pathpersample = values.shape[0] // samples.shape[0]
+        pathvar = numpy.var(samples) * pathpersample
+        self.Diagnostics = {'RawVariancePerPath': rawvar,
+                            'VariancePerPath': pathvar,
+                            'VarianceReduction': rawvar / pathvar if pathvar > 0.0 else float('inf'),
+                            'ControlBeta': beta}
+        return samples
+    
+    def Price(self,nbootstrap = 1000,control=None,method='auto',rng=None):
+        """
+        Compute the option price using simulations
+        
+        Antithetic pairs of the underlying are averaged before computing the 
+        confidence interval. The variance reduction achieved is stored in the 
+        Diagnostics attribute
+        
+        Parameters
+        ----------
+        nbootstrap: int (optional)
+            Number of bootstrap samples (default: 1000)
+        control: str/tuple (optional)
+            Control variate: 'underlying' (discounted terminal value of the 
+            underlying) or (Option, float) for an option with a known price 
+            (default: None)
+        method: str (optional)
+            'bootstrap', 'analytic' (standard error of the mean) or 'auto' 
+            (default: analytic above ANALYTIC_MIN_SAMPLES samples)
+        rng: numpy.random.Generator/int (optional)
+            Random number generator (or seed) of the bootstrap
+        
+        Returns
+        -------
+        type: list
+            [low, mid, high] 95% confidence interval of the option price at t = 0
+        """
+        inst = self.Underlying.Instrumentation
+        with inst.Stage('Samples'):
+            tmpval = self._GetSamples(control)
+        #Bootstrap still better than the normal approximation for small samples
+        #of skewed payoffs (e.g. OTM put)
+        method = self.Underlying.DefaultIntervalMethod(method)
+        if method == 'bootstrap' or (method == 'auto' and tmpval.shape[0] < ANALYTIC_MIN_SAMPLES):
+            inst.Count('BootstrapResamples',nbootstrap)
+        with inst.Stage('ConfidenceInterval'):
+            return ConfidenceInterval(tmpval,nbootstrap,method,rng)
+    
+    def PrecisionReport(self,npath=10000,s0=None,rng=None):
+        """
+        Compare the prices obtained with single and double precision simulations 
+        on a sample of paths driven by the same normal shocks, to check that the
+        float32 compute mode does not bias the price
+        
+        Parameters
+        ----------
+        npath: int (optional)
+            Number of paths of the sample (default: 10000, rounded up to a power
+            of 2 with the 'sobol' sampling)
+        s0: float (optional)
+            Initial value of the underlying (default: the one of the generated 
+            paths)
+        rng: numpy.random.SeedSequence/numpy.random.Generator/int (optional)
+            Root seed of the sample (default: the Seed attribute of the underlying)
+            
+        Returns
+        -------
+        type: dict
+            Price64 and Price32 (prices of the sample), AbsoluteError and 
+            RelativeError (between the two prices), MaxPathError (largest 
+            difference on a discounted payoff) and StandardError (Monte Carlo
+            standard error of the sample price, for comparison)
+        """
+        u = self.Underlying
+        if s0 is None:
+            s0 = u.S0
+        npath += npath % 2 if u.Antithetic else 0
+        if u.Sampling == 'sobol':
+            #Balanced Sobol sample: rounded up to a power of 2
+            npath = 2 ** int(math.ceil(math.log(npath,2)))
+        values = {}
+        for dtype in [numpy.float64,numpy.float32]:
+            shell = u._Shell()
+            shell.ComputeDType = shell.DType = numpy.dtype(dtype)
+            if dtype is numpy.float64:
+                root = u._RootSeed(rng)
+                if u.Sampling == 'sobol':
+                    normals = shell._DrawSobolNormals(npath,0,shell._BatchGenerator(root,0))
+                else:
+                    normals = shell._DrawNormals(npath,shell._BatchGenerator(root,0))
+            fullpaths = self.PayoffType != 'terminal' or self._HorizonColumns() < u.NPeriod
+            paths = numpy.empty((npath,u.NPeriod),dtype=dtype) if fullpaths else None
+            terminal = shell._Advance(s0,normals.astype(dtype),paths)
+            values[dtype] = self._GetBatchValues(paths,terminal)
+        price64 = values[numpy.float64].mean()
+        price32 = values[numpy.float32].mean()
+        return {'Price64': price64,
+                'Price32': price32,
+                'AbsoluteError': abs(price32 - price64),
+                'RelativeError': abs(price32 - price64) / abs(price64) if price64 != 0.0 else float('inf'),
+                'MaxPathError': numpy.abs(values[numpy.float32] - values[numpy.float64]).max(),
+                'StandardError': values[numpy.float64].std() / math.sqrt(npath)}
+    
+    def _PayoffDerivative(self,terminal,eps=1e-6):
+        """
+        Derivative of a 'terminal' payoff at the terminal value of each path, by 
+        central difference
+        """
+        h = eps * numpy.maximum(numpy.abs(terminal),1.0)
+        up = numpy.asarray(self.Payoff(terminal + h),dtype=float)
+        down = numpy.asarray(self.Payoff(terminal - h),dtype=float)
+        return (up - down) / (2.0 * h)
+    
+    def Greeks(self,method='auto',bump=0.01,smooth=False):
+        """
+        Compute the delta, gamma and vega (sensitivity to the Vol attribute) of the
+        option from the simulated paths only, without new random draws
+        
+        Methods
+        -------
+        'pathwise': pathwise delta and vega. Gamma from the likelihood 
+            ratio/pathwise mixed estimator with the exact scheme, from bumped 
+            pathwise deltas otherwise. Black-Scholes-Merton, 'terminal' payoffs 
+            only
+        'lr': likelihood ratio estimators (Black-Scholes-Merton exact scheme, 
+            'terminal' payoffs), which do not need the payoff to be differentiable
+        'bump': bump-and-revalue with common random numbers. Paths are scaled for
+            the delta and gamma when they are proportional to S0, and recomputed
+            from the normal shocks otherwise (stored with storenormals=True, or 
+            recovered from the Black-Scholes-Merton paths). Works for any payoff 
+            and any model
+        'auto': for 'terminal' payoffs on the Horizon of a Black-Scholes-Merton 
+            underlying, 'pathwise' if the payoff is smooth, else 'lr' with the 
+            exact scheme; 'bump' otherwise
+        
+        Parameters
+        ----------
+        method: str (optional)
+            Estimation method (default: 'auto')
+        bump: float (optional)
+            Relative bump of S0 and vol for the finite differences (default: 1%)
+        smooth: bool (optional)
+            True if the payoff is differentiable (e.g. not a digital), so that 
+            'auto' may use the pathwise method (default: False)
+            
+        Returns
+        -------
+        type: dict
+            [low, mid, high] 95% confidence interval of 'Price', 'Delta', 'Gamma'
+            and 'Vega' (unless the model does not use the Vol attribute)
+        """
+        u = self.Underlying
+        extended = self._HorizonColumns() < u.NPeriod
+        if method == 'auto':
+            method = 'bump'
+            if self.PayoffType == 'terminal' and u.Model == 'bs' and not extended:
+                if smooth:
+                    method = 'pathwise'
+                elif u.Scheme == 'exact':
+                    method = 'lr'
+        if method in ['pathwise','lr'] and (self.PayoffType != 'terminal' or u.Model != 'bs'):
+            raise ValueError("The {} method needs a 'terminal' payoff and the Black-Scholes-Merton model".format(method))
+        if method != 'bump':
+            self._CheckHorizon("The {} method".format(method))
+        #Normal shocks needed by the pathwise vega of the Euler scheme and by the 
+        #revaluations of the bump method
+        vegabump = u.Vol is not None and u.Dynamics.UsesVol
+        if method == 'pathwise':
+            needshocks = u.Scheme != 'exact'
+        else:
+            needshocks = method == 'bump' and (vegabump or not u.Dynamics.Homogeneous)
+        if needshocks and not u._HasShocks():
+            raise ValueError("The {} method needs the normal shocks: use storenormals=True".format(method))
+        df = u.Discount(self.Expiry)
+        s0 = u.S0
+        sigma = u.Vol
+        T = u.Times[-1]
+        values = self._GetValues()
+        terminal = numpy.asarray(u.GetLastItems(),dtype=float)
+        if method == 'pathwise':
+            ratio = terminal / s0
+            dpayoff = df * self._PayoffDerivative(terminal)
+            if not numpy.any(dpayoff):
+                raise ValueError("The payoff derivative is zero on every path (e.g. digital payoff): use the 'lr' or 'bump' method")
+            delta = dpayoff * ratio
+            vega = dpayoff * u.VolSensitivity()
+            if u.Scheme == 'exact':
+                gamma = dpayoff * ratio / s0 * (u.TerminalBrownian() / (sigma * T) - 1.0)
+            else:
+                #S(T) is proportional to S0: bumped pathwise deltas with the same paths
+                up = self._PayoffDerivative(terminal * (1.0 + bump))
+                down = self._PayoffDerivative(terminal * (1.0 - bump))
+                gamma = df * ratio * (up - down) / (2.0 * bump * s0)
+        elif method == 'lr':
+            if u.Scheme != 'exact':
+                raise ValueError("The likelihood ratio method needs the exact scheme")
+            zeta = u.TerminalBrownian() / math.sqrt(T)
+            sqrtT = math.sqrt(T)
+            delta = values * zeta / (s0 * sigma * sqrtT)
+            gamma = values * ((zeta ** 2 - 1.0) / (s0 ** 2 * sigma ** 2 * T) - zeta / (s0 ** 2 * sigma * sqrtT))
+            vega = values * ((zeta ** 2 - 1.0) / sigma - zeta * sqrtT)
+        elif method == 'bump':
+            if u.Dynamics.Homogeneous:
+                full = u.Values if u.Storage == 'full' else None
+                scaled = lambda x: None if full is None else full * x
+                up = self._GetBatchValues(scaled(1.0 + bump),terminal * (1.0 + bump))
+                down = self._GetBatchValues(scaled(1.0 - bump),terminal * (1.0 - bump))
+            else:
+                up = self._GetBatchValues(*u.Revalue(s0=s0 * (1.0 + bump)))
+                down = self._GetBatchValues(*u.Revalue(s0=s0 * (1.0 - bump)))
+            h = bump * s0
+            delta = (up - down) / (2.0 * h)
+            gamma = (up - 2.0 * values + down) / h ** 2
+            vega = None
+            if vegabump:
+                volup = self._GetBatchValues(*u.Revalue(vol=sigma * (1.0 + bump)))
+                voldown = self._GetBatchValues(*u.Revalue(vol=sigma * (1.0 - bump)))
+                vega = (volup - voldown) / (2.0 * bump * sigma)
+        else:
+            raise ValueError("Unknown method: {}".format(method))
+        interval = lambda x: ConfidenceInterval(u.IndependentSamples(x),method='analytic')
+        greeks = {'Price': interval(values),
+                  'Delta': interval(delta),
+                  'Gamma': interval(gamma)}
+        if vega is not None:
+            greeks['Vega'] = interval(vega)
+        return greeks
+    
+    def StreamPrice(self,s0,rng=None,npath=None):
+        """
+        Compute the option price by generating the underlying paths batch by batch.
+        Only running sums of the payoffs are kept, so the memory does not depend
+        on the number of paths
+        
+        Parameters
+        ----------
+        s0: float
+            Initial value of the underlying
+        rng: numpy.random.SeedSequence/numpy.random.Generator/int (optional)
+            Root seed, generator or integer seed. Default: the Seed attribute of 
+            the underlying
+        npath: int (optional)
+            Number of paths to simulate (default: NPath of the underlying)
+            
+        Returns
+        -------
+        type: list
+            [low, mid, high] 95% confidence interval of the option price at t = 0
+        """
+        u = self.Underlying
+        if npath is None:
+            npath = u.NPath
+        if u.Sampling == 'sobol':
+            #Running sum of each replicate
+            m = u._ReplicateSize(npath)
+            replicates = numpy.zeros(u.NReplicate)
+        n = 0
+        moments = RunningMoments()
+        for batch in u.IterBatches(s0,rng,npath):
+            val = self._GetStreamValues(batch)
+            if u.Sampling == 'sobol':
+                replicates[n // m] += val.sum(dtype=numpy.float64)
+                n += val.shape[0]
+                continue
+            moments.Update(u.IndependentSamples(val))
+        if u.Sampling == 'sobol':
+            return ConfidenceInterval(replicates / m,method='analytic')
+        return moments.Interval()
+    
+    def _GetStreamValues(self,batch):
+        """
+        Compute the discounted payoffs of a batch yielded by PathGenerator.IterBatches
+        """
+        if batch.ndim == 1:
+            return self._GetBatchValues(None,batch)
+        return self._GetBatchValues(batch,batch[:,-1])
+    
+    def PriceToTolerance(self,s0,atol=None,rtol=None,maxpaths=10**8,maxtime=None,rng=None):
+        """
+        Compute the option price by generating batches of paths until the half-width
+        of the 95% confidence interval drops below a tolerance, or a path or time
+        budget runs out. The mean and variance of the payoffs are updated batch by
+        batch (Welford/Chan updates), so memory does not depend on the number of 
+        paths. The number of paths used, the elapsed time and whether the 
+        tolerance was reached are stored in the Diagnostics attribute
+        
+        Parameters
+        ----------
+        s0: float
+            Initial value of the underlying
+        atol: float (optional)
+            Absolute tolerance on the half-width
+        rtol: float (optional)
+            Tolerance on the half-width relative to the price
+        maxpaths: int (optional)
+            Maximum number of paths (default: 10**8)
+        maxtime: float (optional)
+            Maximum time in seconds
+        rng: numpy.random.SeedSequence/numpy.random.Generator/int (optional)
+            Root seed, generator or integer seed. Default: the Seed attribute of 
+            the underlying
+            
+        Returns
+        -------
+        type: list
+            [low, mid, high] 95% confidence interval of the option price at t = 0
+        """
+        u = self.Underlying
+        if u.Sampling == 'sobol':
+            raise ValueError("Adaptive pricing needs the 'pseudo' sampling")
+        if atol is None and rtol is None:
+            raise ValueError("A tolerance (atol or rtol) must be provided")
+        start = time.perf_counter()
+        npath = 0
+        converged = False
+        moments = RunningMoments()
+        for batch in u.IterBatches(s0,rng,maxpaths):
+            val = self._GetStreamValues(batch)
+            npath += val.shape[0]
+            moments.Update(u.IndependentSamples(val))
+            halfwidth = moments.HalfWidth()
+            tol = max(atol or 0.0,(rtol or 0.0) * abs(moments.Mean))
+            if moments.N > 1 and halfwidth <= tol:
+                converged = True
+                break
+            if maxtime is not None and time.perf_counter() - start >= maxtime:
+                break
+        self.Diagnostics = {'NPath': npath,
+                            'Elapsed': time.perf_counter() - start,
+                            'Converged': converged,
+                            'HalfWidth': moments.HalfWidth()}
+        return moments.Interval()
+
+
+class AmericanOption(Option):
+    """
+    Option with early exercise (American or Bermudan), priced with the 
+    Longstaff-Schwartz least-squares Monte Carlo algorithm on the path matrix
+    
+    Every valuation of a set of paths runs its own backward induction: 
+    StreamPrice and PriceToTolerance regress the exercise policy batch by batch,
+    and the bump-and-revalue Greeks (the only method available) re-run it on the
+    bumped paths
+    """
+    def __init__(self,payoff,underlying,exercisedates=None,basis='laguerre',degree=3):
+        """
+        Parameters
+        ----------
+        payoff: function(numpy.ndarray -> numpy.ndarray)
+            Exercise value as a function of the underlying values (vectorized)
+        underlying: PathGenerator
+            Underlying PathGenerator instance ('full' storage)
+        exercisedates: array-like (optional)
+            Increasing exercise dates (default: every date of the underlying after
+            t = 0, i.e. an American option). The last one is the expiry
+        basis: str (optional)
+            Regression basis of the continuation value: 'laguerre' (default) or 
+            'polynomial'
+        degree: int (optional)
+            Degree of the regression basis (default: 3)
+        """
+        if basis not in ['laguerre','polynomial']:
+            raise ValueError("Unknown regression basis: {}".format(basis))
+        if exercisedates is None:
+            exercisedates = underlying.Times[1:]
+        self.ExerciseDates = numpy.asarray(exercisedates,dtype=float)
+        #The exercise decisions depend on the whole path matrix: the payoff is 
+        #handled as a 'matrix' payoff (full storage, bump-and-revalue Greeks)
+        Option.__init__(self,payoff,underlying,self.ExerciseDates[-1],'matrix')
+        self.Basis = basis
+        self.Degree = degree
+        self.Exercised = None
+        
+    def _Regressors(self,x):
+        """
+        Returns the regression matrix of the continuation value
+        
+        Parameters
+        ----------
+        x: numpy.ndarray
+            Underlying values normalized by the initial value
+            
+        Returns
+        -------
+        type: numpy.ndarray
+            (len(x), Degree + 1) matrix of basis functions
+        """
+        if self.Basis == 'laguerre':
+            return numpy.exp(-0.5 * x)[:,None] * numpy.polynomial.laguerre.lagvander(x,self.Degree)
+        return numpy.polynomial.polynomial.polyvander(x,self.Degree)
+        
+    def _Induction(self,paths):
+        """
+        Run the Longstaff-Schwartz backward induction on a path matrix
+        
+        Parameters
+        ----------
+        paths: numpy.ndarray
+            (n, NPeriod) path matrix
+        
+        Returns
+        -------
+        type: tuple
+            (numpy.ndarray, numpy.ndarray) discounted cash flow of each path at 
+            t = 0, and index of its exercise date (len(ExerciseDates): never 
+            exercised)
+        """
+        u = self.Underlying
+        spots = u.GetItemsByDate(self.ExerciseDates,paths)
+        ndate = self.ExerciseDates.shape[0]
+        discount = u.Discount(self.ExerciseDates)
+        #Index of the exercise date of each path (ndate: never exercised)
+        exercise = numpy.full(spots.shape[0],ndate,dtype=int)
+        u.Instrumentation.Count('PayoffEvaluations',spots.size)
+        cashflow = numpy.asarray(self.Payoff(spots[:,-1]),dtype=float)
+        exercise[cashflow > 0.0] = ndate - 1
+        for i in range(ndate - 2,-1,-1):
+            intrinsic = numpy.asarray(self.Payoff(spots[:,i]),dtype=float)
+            itm = numpy.flatnonzero(intrinsic > 0.0)
+            if itm.shape[0] <= self.Degree + 1:
+                continue
+            #Cash flows of the in-the-money paths discounted to the i-th date
+            future = cashflow[itm] * discount[numpy.minimum(exercise[itm],ndate - 1)] / discount[i]
+            future[exercise[itm] == ndate] = 0.0
+            with u.Instrumentation.Stage('Regression'):
+                X = self._Regressors(spots[itm,i] / u.S0)
+                coef = numpy.linalg.lstsq(X,future,rcond=None)[0]
+            stop = itm[intrinsic[itm] > numpy.dot(X,coef)]
+            cashflow[stop] = intrinsic[stop]
+            exercise[stop] = i
+        exercised = exercise < ndate
+        values = numpy.zeros(spots.shape[0])
+        values[exercised] = cashflow[exercised] * discount[exercise[exercised]]
+        return values, exercise
+        
+    def _GetBatchValues(self,values,terminal):
+        """
+        Run the backward induction on a batch of paths, see Option._GetBatchValues
+        """
+        if values is None:
+            raise ValueError("Early exercise needs the 'full' path storage")
+        return self._Induction(values)[0]
+        
+    def _GetValues(self):
+        """
+        Run the Longstaff-Schwartz backward induction on the paths of the 
+        underlying and returns the discounted cash flow of each path. The exercise
+        decisions are stored in the Exercised attribute, a 
+        (NPath, len(ExerciseDates)) boolean matrix
+        
+        Parameters
+        ----------
+        None
+        
+        Returns
+        -------
+        type: numpy.ndarray
+            Discounted cash flow of each path at t = 0
+        """
+        u = self.Underlying
+        if u.Storage != 'full':
+            raise ValueError("Early exercise needs the 'full' path storage")
+        values, exercise = self._Induction(u.Values)
+        ndate = self.ExerciseDates.shape[0]
+        self.Exercised = numpy.zeros((values.shape[0],ndate),dtype=bool)
+        exercised = exercise < ndate
+        self.Exercised[numpy.flatnonzero(exercised),exercise[exercised]] = True
+        return values
+
+    def Price(self,nbootstrap=1000,control=None,method='auto',rng=None):
+        """
+        Compute the option price with the Longstaff-Schwartz algorithm. The 
+        regression and the valuation use the same paths (in-sample estimate). The
+        probability of exercise and of exercise before the last date are added to
+        the Diagnostics attribute
+        
+        Parameters
+        ----------
+        nbootstrap: int (optional)
+            Number of bootstrap samples (default: 1000)
+        control: str/tuple (optional)
+            Control variate, see Option.Price (e.g. the European option with its
+            Black-Scholes price)
+        method: str (optional)
+            'bootstrap', 'analytic' or 'auto' (see Option.Price)
+        rng: numpy.random.Generator/int (optional)
+            Random number generator (or seed) of the bootstrap
+            
+        Returns
+        -------
+        type: list
+            [low, mid, high] 95% confidence interval of the option price at t = 0
+        """
+        ci = Option.Price(self,nbootstrap,control,method,rng)
+        self.Diagnostics['ExerciseProbability'] = float(self.Exercised.any(axis=1).mean())
+        self.Diagnostics['EarlyExerciseProbability'] = float(self.Exercised[:,:-1].any(axis=1).mean())
+        return ci
+
+
+class RunningMoments:
+    """
+    Running mean and variance of a stream of samples, updated batch by batch
+    (Welford's algorithm, merged by batch as in Chan et al.)
+    """
+    def __init__(self):
+        self.N = 0
+        self.Mean = 0.0
+        self.M2 = 0.0
+        
+    def Update(self,samples):
+        """
+        Add a batch of samples
+        
+        Parameters
+        ----------
+        samples: numpy.ndarray
+            New samples
+            
+        Returns
+        -------
+        None
+        """
+        n = samples.shape[0]
+        if n == 0:
+            return
+        mean = samples.mean(dtype=numpy.float64)
+        m2 = numpy.square(samples - mean,dtype=numpy.float64).sum()
+        total = self.N + n
+        delta = mean - self.Mean
+        self.Mean += delta * n / total
+        self.M2 += m2 + delta ** 2 * self.N * n / total
+        self.N = total
+        
+    def Variance(self):
+        """
+        Returns the sample variance
+        """
+        return self.M2 / (self.N - 1) if self.N > 1 else float('inf')
+        
+    def HalfWidth(self):
+        """
+        Returns the half-width of the 95% confidence interval of the mean
+        """
+        return 1.96 * math.sqrt(self.Variance() / self.N) if self.N > 1 else float('inf')
+        
+    def Interval(self):
+        """
+        Returns the [low, mid, high] 95% confidence interval of the mean
+        """
+        hw = self.HalfWidth()
+        return [self.Mean - hw, self.Mean, self.Mean + hw]
+
+
+class Book:
+    """
+    Book of options sharing the same PathGenerator, priced in a single pass over
+    the path matrix
+    """
+    def __init__(self,underlying,blocksize=256):
+        """
+        Parameters
+        ----------
+        underlying: PathGenerator
+            PathGenerator instance shared by all the options of the book
+        blocksize: int (optional)
+            Maximum number of strikes of a vanilla strip valued at once. Bounds
+            the memory used by the (NPath, blocksize) payoff matrix (default: 256)
+        """
+        self.Underlying = underlying
+        self.BlockSize = blocksize
+        self.Instruments = []
+        self._Groups = []
+        self.Timings = []
+        
+    def Add(self,option):
+        """
+        Add an Option instance to the book
+        
+        Parameters
+        ----------
+        option: Option
+            Option on the underlying of the book
+            
+        Returns
+        -------
+        None
+        """
+        if option.Underlying is not self.Underlying:
+            raise ValueError("The option must be written on the underlying of the book")
+        self.Instruments.append(option)
+        self._Groups.append(('option',option))
+        
+    def AddVanillas(self,strikes,kind='call',expiry=None):
+        """
+        Add a strip of European vanilla options. The payoffs of the whole strip are
+        computed at once, the strikes being handled as an array
+        
+        Parameters
+        ----------
+        strikes: array-like
+            Strikes of the options
+        kind: str (optional)
+            'call' (default) or 'put'
+        expiry: float (optional)
+            Expiry date of the options (default: TotalTime of the underlying). The
+            underlying is read at this date, or at the last date of the paths if
+            the expiry is after it. This date is kept if the horizon of the 
+            underlying is extended later (see Option)
+            
+        Returns
+        -------
+        None
+        """
+        if kind not in ['call','put']:
+            raise ValueError("Unknown option kind: {}".format(kind))
+        u = self.Underlying
+        if expiry is None:
+            expiry = u.TotalTime
+        if expiry > max(u.TotalTime,u.Times[-1]):
+            raise ValueError("Expiry {} after the horizon of the underlying".format(expiry))
+        strikes = numpy.asarray(strikes,dtype=float).ravel()
+        for k in strikes:
+            self.Instruments.append((kind,k,expiry))
+        #Date at which the underlying is read
+        horizon = min(expiry,u.Times[-1])
+        self._Groups.append(('vanillas',(strikes,kind,expiry,horizon)))
+    
+    def _VanillaValues(self,strikes,kind,expiry,horizon):
+        """
+        Compute the discounted payoffs of a block of vanilla options
+        
+        Parameters
+        ----------
+        strikes: numpy.ndarray
+            Strikes of the block
+        kind: str
+            'call' or 'put'
+        expiry: float
+            Expiry date
+        horizon: float
+            Date at which the underlying is read
+            
+        Returns
+        -------
+        type: numpy.ndarray
+            (NPath, len(strikes)) matrix of discounted payoffs
+        """
+        u = self.Underlying
+        if horizon != u.Times[-1] and u.Storage == 'terminal':
+            raise ValueError("The 'terminal' storage does not keep the values at the horizon of the options")
+        terminal = numpy.asarray(u.GetItemsByDate(horizon),dtype=float)[:,None]
+        if kind == 'call':
+            payoffs = numpy.maximum(terminal - strikes[None,:],0.0)
+        else:
+            payoffs = numpy.maximum(strikes[None,:] - terminal,0.0)
+        payoffs *= self.Underlying.Discount(expiry)
+        return payoffs
+        
+    def Price(self,nbootstrap=1000,method='auto',rng=None):
+        """
+        Compute the price of every instrument of the book over the shared paths
+        
+        The same bootstrap resamples are used for all the instruments of a block.
+        The time spent on each instrument is stored in the Timings attribute
+        
+        Parameters
+        ----------
+        nbootstrap: int (optional)
+            Number of bootstrap samples (default: 1000)
+        method: str (optional)
+            'bootstrap', 'analytic' or 'auto' (see ConfidenceInterval)
+        rng: numpy.random.Generator/int (optional)
+            Random number generator (or seed) of the bootstrap
+            
+        Returns
+        -------
+        type: list
+            [low, mid, high] 95% confidence interval of each instrument price, in
+            the order the instruments were added
+        """
+        rng = numpy.random.default_rng(rng)
+        method = self.Underlying.DefaultIntervalMethod(method)
+        prices = []
+        self.Timings = []
+        for kind, item in self._Groups:
+            if kind == 'option':
+                start = time.perf_counter()
+                prices.append(item.Price(nbootstrap,method=method,rng=rng))
+                self.Timings.append(time.perf_counter() - start)
+                continue
+            strikes, optkind, expiry, horizon = item
+            for first in range(0,strikes.shape[0],self.BlockSize):
+                block = strikes[first:first + self.BlockSize]
+                start = time.perf_counter()
+                inst = self.Underlying.Instrumentation
+                inst.Count('PayoffEvaluations',block.shape[0] * self.Underlying.NPath)
+                with inst.Stage('Payoff'):
+                    samples = self.Underlying.IndependentSamples(self._VanillaValues(block,optkind,expiry,horizon))
+                with inst.Stage('ConfidenceInterval'):
+                    low, mid, high = ConfidenceInterval(samples,nbootstrap,method,rng)
+                elapsed = (time.perf_counter() - start) / block.shape[0]
+                for i in range(block.shape[0]):
+                    prices.append([low[i],mid[i],high[i]])
+                    self.Timings.append(elapsed)
+        return prices
+
+
+def Bootstrap(samples,nbootstrap=1000,rng=None):
+    """
+    Compute the means of bootstrap resamples. Resample indices are drawn as an 
+    integer matrix, by chunks of at most BOOTSTRAP_CHUNK_ELEMENTS elements
+    
+    Parameters
+    ----------
+    samples: numpy.ndarray
+        Samples of shape (n,) or (n, k). In the latter case, the same resamples
+        are used for the k columns
+    nbootstrap: int (optional)
+        Number of bootstrap resamples (default: 1000)
+    rng: numpy.random.Generator/int (optional)
+        Random number generator (or seed)
+        
+    Returns
+    -------
+    type: numpy.ndarray
+        Means of the resamples, of shape (nbootstrap,) or (nbootstrap, k)
+    """
+    rng = numpy.random.default_rng(rng)
+    samples = numpy.asarray(samples,dtype=numpy.float64)
+    n = samples.shape[0]
+    chunk = max(1,BOOTSTRAP_CHUNK_ELEMENTS // max(1,n))
+    means = numpy.empty((nbootstrap,) + samples.shape[1:])
+    for start in range(0,nbootstrap,chunk):
+        size = min(chunk,nbootstrap - start)
+        ind = rng.integers(0,n,size=(size,n))
+        #Number of times each sample is drawn by each resample: the means of all 
+        #the columns are then a single matrix product
+        ind += numpy.arange(size)[:,None] * n
+        counts = numpy.bincount(ind.ravel(),minlength=size * n).reshape(size,n)
+        means[start:start + size] = numpy.dot(counts,samples) / n
+    return means
+
+
+def ConfidenceInterval(samples,nbootstrap=1000,method='auto',rng=None):
+    """
+    Compute the 95% confidence interval of the mean of independent samples
+    
+    Parameters
+    ----------
+    samples: numpy.ndarray
+        Samples of shape (n,) or (n, k) (one interval per column)
+    nbootstrap: int (optional)
+        Number of bootstrap resamples (default: 1000)
+    method: str (optional)
+        'bootstrap', 'analytic' (standard error of the mean, with the Student-t
+        quantile below STUDENT_MAX_SAMPLES samples) or 'auto' (default: analytic
+        above ANALYTIC_MIN_SAMPLES samples)
+    rng: numpy.random.Generator/int (optional)
+        Random number generator (or seed) of the bootstrap
+        
+    Returns
+    -------
+    type: list
+        [low, mid, high]
+    """
+    samples = numpy.asarray(samples)
+    n = samples.shape[0]
+    if method == 'auto':
+        method = 'analytic' if n >= ANALYTIC_MIN_SAMPLES else 'bootstrap'
+    q = 1.96
+    if method == 'analytic':
+        av = samples.mean(axis=0,dtype=numpy.float64)
+        st = samples.std(axis=0,ddof=min(1,n-1),dtype=numpy.float64) / math.sqrt(n)
+        if 1 < n < STUDENT_MAX_SAMPLES:
+            import scipy.stats
+            q = scipy.stats.t.ppf(0.975,n - 1)
+    elif method == 'bootstrap':
+        bootstrap = Bootstrap(samples,nbootstrap,rng)
+        av = bootstrap.mean(axis=0)
+        st = bootstrap.std(axis=0)
+    else:
+        raise ValueError("Unknown confidence interval method: {}".format(method))
+    return [av - q * st, av ,av + q * st]
+
+
+def BlackScholesPrice(s0,k,r,sigma,t,kind='call'):
+    """
+    Closed form price of a European option in the Black-Scholes-Merton model
+    
+    Parameters
+    ----------
+    s0: float
+        Initial value of the underlying
+    k: float
+        Strike
+    r: float
+        Continuously compounded risk-free rate
+    sigma: float
+        Volatility of the underlying
+    t: float
+        Time to expiry
+    kind: str (optional)
+        'call' (default) or 'put'
+        
+    Returns
+    -------
+    type: float
+        Option price at t = 0
+    """
+    import scipy.stats
+    N = scipy.stats.norm.cdf
+    d1 = (1.0/(sigma *math.sqrt(t))) * (math.log(s0/k)+(r+(sigma**2.0)/2.0)*t)
+    d2 = d1 - sigma * math.sqrt(t)
+    if kind == 'call':
+        return s0 * N(d1) - k * math.exp(-r*t) * N(d2)
+    return -s0 * N(-d1) + k * math.exp(-r*t) * N(-d2)
+
+
+def main(argv=None):
+    """
+    Demo: price a European call and put on the S&P 500 with the different 
+    simulation schemes and compare them with the closed-form prices
+    
+    Parameters
+    ----------
+    argv: list (optional)
+        Command line arguments (default: sys.argv)
+        
+    Returns
+    -------
+    None
+    """
+    import argparse
+    #Filled with some data ~ today
+    libor = 0.76944/100.0
+    parser = argparse.ArgumentParser(description="Monte Carlo pricing of a European call and put")
+    parser.add_argument('--s0',type=float,default=2267.89,help="Initial value of the underlying")
+    parser.add_argument('--strike',type=float,default=2250.0)
+    parser.add_argument('--rate',type=float,default=12.0 * math.log(1+libor/12.0),help="Continuously compounded risk-free rate")
+    parser.add_argument('--vol',type=float,default=0.06) #0.1177
+    parser.add_argument('--maturity',type=float,default=1.0/12.0)
+    parser.add_argument('--nperiod',type=int,default=1000)
+    parser.add_argument('--npath',type=int,default=2000)
+    parser.add_argument('--seed',type=int,default=None)
+    parser.add_argument('--plot',action='store_true',help="Plot the distribution of the terminal values and a path")
+    args = parser.parse_args(argv)
+    S0, K, r, sigma, t = args.s0, args.strike, args.rate, args.vol, args.maturity
+    npath = args.npath
+    
+    pg = PathGenerator(npath,t,t/args.nperiod,'bs',r,sigma,seed=args.seed,curve=r)
+    pg.GeneratePaths(S0)
+    #Bootstrap resamples also reproducible with --seed
+    rng = numpy.random.default_rng(args.seed)
+    
+    plainvanillacall = Option(lambda x: numpy.maximum(x[:,-1] - K,0),pg,payofftype='matrix')
+    plainvanillaput = Option(lambda x: numpy.maximum(K - x[:,-1],0),pg,payofftype='matrix')
+    
+    print("Call price data: {}".format(plainvanillacall.Price(rng=rng)))
+    print("Put price data: {}".format(plainvanillaput.Price(rng=rng)))
+    
+    #Exact log-normal step: a single draw per path for a European option
+    pgexact = PathGenerator(npath,t,t,'bs',r,sigma,dates=[t],scheme='exact',seed=args.seed,curve=r)
+    pgexact.GeneratePaths(S0)
+    print("Call price data (exact scheme): {}".format(Option(lambda x: numpy.maximum(x - K,0),pgexact,payofftype='terminal').Price(rng=rng)))
+    
+    print("Call price data with control variate: {}".format(plainvanillacall.Price(control='underlying',rng=rng)))
+    print("Variance reduction: {}".format(plainvanillacall.Diagnostics['VarianceReduction']))
+    
+    print("Closed form call: {}".format(BlackScholesPrice(S0,K,r,sigma,t,'call')))
+    print("Closed form put: {}".format(BlackScholesPrice(S0,K,r,sigma,t,'put')))
+    
+    print(numpy.mean(pg.GetLastItems()))
+    print(S0 * math.exp(r * plainvanillacall.Expiry))
+    
+    if args.plot:
+        import matplotlib.pyplot as plt
+        from matplotlib.ticker import FuncFormatter
+        
+        def to_percent(y,position):
+            return str(100*y/npath) + '%'
+        
+        plt.hist(pg.GetLastItems(),bins=10)
+        plt.gca().yaxis.set_major_formatter(FuncFormatter(to_percent))
+        plt.figure()
+        pg.Paths[0].Plot()
+        #plt.gca().set_ylim([0,2500])
+        plt.show()
 
-print(mean([p.GetLastItem() for p in pg.Paths]))
-print(S0 * math.exp(r * plainvanillacall.Expiry))
 
-pg.Paths[0].Plot()
-#plt.gca().set_ylim([0,2500])
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,73 @@ Created on Mon Feb  6 08:50:41 2017
 @author: clem
 """
 
-from scipy import optimize as opt
+import bisect
+import csv
+import itertools
+import numpy
+
+#Machine epsilon of the float type
+EPSILON = numpy.finfo(float).eps
+
+class _CashFlowDict(dict):
+    """
+    Dictionary of the cash flows (date -> value) of a CashFlowStream, which marks
+    the sorted arrays of the stream as stale when it is modified
+    """
+    def __init__(self,owner,*args,**kwargs):
+        dict.__init__(self,*args,**kwargs)
+        self.Owner = owner
+        
+    def __reduce__(self):
+        #Rebuilt with its items and owner at once: pickle and deepcopy would 
+        #restore the items (through __setitem__) before the Owner attribute
+        return (_CashFlowDict,(self.Owner,dict(self)))
+        
+    def _Modified(self):
+        self.Owner._Stale = True
+        
+    def __setitem__(self,key,value):
+        new = key not in self
+        dict.__setitem__(self,key,value)
+        if new:
+            self.Owner._Append(key,value)
+        else:
+            self._Modified()
+        
+    def __delitem__(self,key):
+        dict.__delitem__(self,key)
+        self._Modified()
+        
+    def clear(self):
+        dict.clear(self)
+        self._Modified()
+        
+    def pop(self,*args):
+        self._Modified()
+        return dict.pop(self,*args)
+        
+    def popitem(self):
+        self._Modified()
+        return dict.popitem(self)
+        
+    def setdefault(self,key,default=None):
+        self._Modified()
+        return dict.setdefault(self,key,default)
+        
+    def update(self,*args,**kwargs):
+        dict.update(self,*args,**kwargs)
+        self._Modified()
+
 
 class CashFlowStream:
     """
     The CashFlowStream classes allows to store a stream of cash flow for a given period
+    
+    The cash flows are kept in the CashFlows dictionary, and in arrays sorted by date
+    with the prefix sums of the values and of the values times the dates (extended
+    when cash flows are added in date order, rebuilt on other changes of the 
+    dictionary). The Modified Dietz return of any window of the period then only 
+    needs two binary searches
     """
     def __init__(self,v0,v1,ndays):
         """
@@ -31,6 +93,22 @@ class CashFlowStream:
         self.InitialValue = v0
         self.EndingValue = v1
         self.NDays = ndays
+        #Values of the portfolio inside the period, by date
+        self.Valuations = {}
+        self.Diagnostics = {}
+        
+    @property
+    def CashFlows(self):
+        """
+        Dictionary date -> value of the external cash flows
+        """
+        return self._CashFlows
+        
+    @CashFlows.setter
+    def CashFlows(self,cashflows):
+        self._CashFlows = _CashFlowDict(self,cashflows)
+        self._Stale = True
+        self._Pending = []
         
     def AddCashFlow(self,date,cf):
         """
@@ -45,57 +123,854 @@ class CashFlowStream:
         """
         self.CashFlows[date]=cf
         
-    def _LossFunction(self,r):
+    def AddValuation(self,date,value):
+        """
+        Add the value of the portfolio at a date inside the period, to compute the 
+        return of the windows starting or ending at this date
+        
+        Parameters
+        ----------
+        date: float
+            Number of days (or subperiod) at which the portfolio is valued
+        value: float
+            Value of the portfolio (before the cash flows of the date)
         """
-        Loss function to compute the Modified IRR
+        self.Valuations[date] = value
+        
+    def Value(self,date):
+        """
+        Returns the value of the portfolio at a date: InitialValue at 0, EndingValue
+        at NDays, else a value added with AddValuation
         
         Parameters
         ----------
-        r: float array
-            Array of one element (due to the minimize method of scipy.optimize)
+        date: float
+            Number of days (or subperiod)
             
         Returns
         -------
         type: float
-            Loss value for the Modified IRR optimization
+            Value of the portfolio
         """
-        return (sum([cf * ((1.0 + r[0]) ** ((self.NDays - d)/self.NDays)) for d, cf in self.CashFlows.iteritems()]) + self.InitialValue * (1.0 + r[0]) - self.EndingValue) ** 2.0
+        if date == 0:
+            return self.InitialValue
+        if date == self.NDays:
+            return self.EndingValue
+        try:
+            return self.Valuations[date]
+        except KeyError:
+            raise ValueError("No valuation of the portfolio at date {}".format(date))
         
-    def ModifiedDietz(self):
+    def _Build(self):
         """
-        Compute the Modified Dietz return
+        Sort the cash flows by date and compute the prefix sums of the values and of
+        the values times the dates
+        """
+        n = len(self.CashFlows)
+        dates = numpy.fromiter(self.CashFlows.keys(),dtype=float,count=n)
+        cfs = numpy.fromiter(self.CashFlows.values(),dtype=float,count=n)
+        order = numpy.argsort(dates,kind='stable')
+        self._Dates = dates[order]
+        self._Amounts = cfs[order]
+        self._CumAmounts = numpy.concatenate(([0.0],numpy.cumsum(self._Amounts)))
+        self._CumDated = numpy.concatenate(([0.0],numpy.cumsum(self._Amounts * self._Dates)))
+        self._Stale = False
+        self._Pending = []
+        
+    def _Append(self,date,cf):
+        """
+        Record a new cash flow. A cash flow dated after all the others is kept 
+        aside and only extends the sorted arrays, else they are rebuilt
         
         Parameters
         ----------
-        None
+        date: float
+            Number of days (or subperiod) at which the cash flow occurs
+        cf: float
+            Value of the cash flow
+        """
+        if not self._Stale:
+            if self._Pending:
+                last = self._Pending[-1][0]
+            else:
+                last = self._Dates[-1] if self._Dates.shape[0] > 0 else -numpy.inf
+            if date > last:
+                self._Pending.append((date,cf))
+                return
+        self._Stale = True
+        
+    def _Extend(self):
+        """
+        Append the pending cash flows to the sorted arrays and their prefix sums
+        """
+        dates = numpy.array([p[0] for p in self._Pending],dtype=float)
+        cfs = numpy.array([p[1] for p in self._Pending],dtype=float)
+        self._Dates = numpy.concatenate((self._Dates,dates))
+        self._Amounts = numpy.concatenate((self._Amounts,cfs))
+        self._CumAmounts = numpy.concatenate((self._CumAmounts,self._CumAmounts[-1] + numpy.cumsum(cfs)))
+        self._CumDated = numpy.concatenate((self._CumDated,self._CumDated[-1] + numpy.cumsum(cfs * dates)))
+        self._Pending = []
+        
+    def _Window(self,start,end,closed=True):
+        """
+        Returns the slice of the sorted cash flows dated inside a window
+        
+        Parameters
+        ----------
+        start: float
+            Start of the window (included)
+        end: float
+            End of the window
+        closed: bool (optional)
+            True (default) if the cash flows at the end date are included
+            
+        Returns
+        -------
+        type: tuple
+            (int, int) first and last + 1 indices in the sorted arrays
+        """
+        if self._Stale:
+            self._Build()
+        elif self._Pending:
+            self._Extend()
+        lo = int(numpy.searchsorted(self._Dates,start,'left'))
+        hi = int(numpy.searchsorted(self._Dates,end,'right' if closed else 'left'))
+        return lo, hi
+    
+    def _Arrays(self,start=0.0,end=None,closed=True):
+        """
+        Returns the weight (end - d)/(end - start) and the value of each cash flow of
+        a window
+        
+        Parameters
+        ----------
+        start: float (optional)
+            Start of the window (default: 0)
+        end: float (optional)
+            End of the window (default: NDays)
+        closed: bool (optional)
+            True (default) if the cash flows at the end date are included
+        
+        Returns
+        -------
+        type: tuple
+            (numpy.ndarray, numpy.ndarray) weights and values
+        """
+        if end is None:
+            end = self.NDays
+        lo, hi = self._Window(start,end,closed)
+        return (end - self._Dates[lo:hi]) / float(end - start), self._Amounts[lo:hi]
+        
+    def ModifiedDietz(self,start=None,end=None,closed=True):
+        """
+        Compute the Modified Dietz return of the period, or of a window of the period
+        
+        Parameters
+        ----------
+        start: float (optional)
+            Start of the window (default: 0). The value of the portfolio must be 
+            known at this date (see Value)
+        end: float (optional)
+            End of the window (default: NDays). The value of the portfolio must be 
+            known at this date
+        closed: bool (optional)
+            True (default) if the cash flows at the end date are included
         
         Returns
         -------
         type: float
             Return computed through the Modified Dietz method
         """
-        weigthedCF = sum([cf * ((self.NDays - d)/self.NDays) for d, cf in self.CashFlows.iteritems()])
-        return (self.EndingValue - self.InitialValue - sum(self.CashFlows.values()))/(self.InitialValue + weigthedCF)
+        start = 0.0 if start is None else start
+        end = self.NDays if end is None else end
+        v0 = self.Value(start)
+        v1 = self.Value(end)
+        lo, hi = self._Window(start,end,closed)
+        total = self._CumAmounts[hi] - self._CumAmounts[lo]
+        #sum(cf * (end - d)) = end * sum(cf) - sum(cf * d)
+        weigthedCF = (end * total - (self._CumDated[hi] - self._CumDated[lo])) / float(end - start)
+        return float((v1 - v0 - total)/(v0 + weigthedCF))
     
-    def ModifiedIRR(self):
+    def ModifiedIRR(self,start=None,end=None,closed=True,tol=4*EPSILON,maxiter=50):
         """
-        Compute the Modified IRR by minimizing a loss function (initial guess: Modified Dietz
-        return)
+        Compute the Modified IRR of the period or of a window of the period, root of 
+        the valuation equation (see SolveModifiedIRR), starting from the Modified 
+        Dietz return. The convergence diagnostics are stored in the Diagnostics 
+        attribute
         
         Parameters
         ----------
-        None
+        start: float (optional)
+            Start of the window (default: 0)
+        end: float (optional)
+            End of the window (default: NDays)
+        closed: bool (optional)
+            True (default) if the cash flows at the end date are included
+        tol: float (optional)
+            Relative tolerance on the last step (default: 4 machine epsilons)
+        maxiter: int (optional)
+            Maximum number of iterations before the Brent fallback (default: 50)
         
         Returns
         -------
         type: float
             Modified IRR
         """
-        initval = self.ModifiedDietz()
-        return opt.minimize(self._LossFunction,[initval],method = 'Powell').x       
+        start = 0.0 if start is None else start
+        end = self.NDays if end is None else end
+        weights, cfs = self._Arrays(start,end,closed)
+        #Infinite guess (zero Dietz denominator) handled by SolveModifiedIRR
+        with numpy.errstate(divide='ignore',invalid='ignore'):
+            guess = self.ModifiedDietz(start,end,closed)
+        r, self.Diagnostics = SolveModifiedIRR(self.Value(start),self.Value(end),weights,cfs,
+                                               guess,tol,maxiter)
+        return r
+        
+        
+def _Valuation(r,v0,v1,weights,cfs):
+    """
+    Valuation equation of the Modified IRR and its first two derivatives
+    
+    Parameters
+    ----------
+    r: float
+        Return of the period (greater than -1)
+    v0, v1: float
+        Initial and ending values of the portfolio
+    weights, cfs: numpy.ndarray
+        Weight (NDays - d)/NDays and value of each cash flow
+        
+    Returns
+    -------
+    type: tuple
+        (f, f', f'') at r
+    """
+    g = cfs * numpy.power(1.0 + r,weights)
+    gw = g * weights
+    #The derivatives are not defined at the bound r = -1 (Brent's method only 
+    #uses the value)
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        return (g.sum() + v0 * (1.0 + r) - v1,
+                gw.sum() / (1.0 + r) + v0,
+                (gw * (weights - 1.0)).sum() / (1.0 + r) ** 2)
+
+
+def SolveModifiedIRR(v0,v1,weights,cfs,guess=0.0,tol=4*EPSILON,maxiter=50):
+    """
+    Solve the valuation equation of the Modified IRR
+    
+    sum(cf * (1 + r) ** ((NDays - d)/NDays)) + V0 * (1 + r) - V1 = 0
+    
+    with Halley steps (analytic first and second derivatives) kept inside a 
+    bracket of the root. A step leaving the bracket is replaced by a Newton 
+    step, then by a bisection; if the bracket is finite and the steps keep being
+    rejected, the root is polished with Brent's method
+    
+    Parameters
+    ----------
+    v0, v1: float
+        Initial and ending values of the portfolio
+    weights, cfs: array-like
+        Weight (NDays - d)/NDays and value of each cash flow
+    guess: float (optional)
+        Initial guess, e.g. the Modified Dietz return (default: 0)
+    tol: float (optional)
+        Relative tolerance on the last step (default: 4 machine epsilons)
+    maxiter: int (optional)
+        Maximum number of iterations before the Brent fallback (default: 50)
+        
+    Returns
+    -------
+    type: tuple
+        (float, dict) root and diagnostics: Converged, Iterations, 
+        FunctionEvaluations (one evaluation gives f, f' and f''), Residual, 
+        Method ('halley' or 'brent') and Bracket
+    """
+    weights = numpy.asarray(weights,dtype=float)
+    cfs = numpy.asarray(cfs,dtype=float)
+    #Limits of the valuation at r = -1 (only the flows at the end of the period 
+    #remain) and at r = +inf (sign of the highest power of 1 + r)
+    lo, hi = -1.0, float('inf')
+    flo = cfs[weights == 0.0].sum() - v1
+    top = max(1.0,weights.max()) if weights.shape[0] else 1.0
+    fhi = cfs[weights == top].sum() + (v0 if top == 1.0 else 0.0)
+    bracketed = flo * fhi < 0.0
+    x = guess if numpy.isfinite(guess) and guess > -1.0 else 0.0
+    nfev = 0
+    rejected = 0
+    converged = False
+    method = 'halley'
+    it = 0
+    f = numpy.nan
+    for it in range(1,maxiter + 1):
+        f, d1, d2 = _Valuation(x,v0,v1,weights,cfs)
+        nfev += 1
+        if f == 0.0:
+            converged = True
+            break
+        if bracketed:
+            if (f < 0.0) == (flo < 0.0):
+                lo, flo = x, f
+            else:
+                hi = x
+        denom = 2.0 * d1 * d1 - f * d2
+        #At a stationary point the Halley step is zero although f != 0
+        new = x - 2.0 * f * d1 / denom if denom != 0.0 and d1 != 0.0 else numpy.nan
+        if not (lo < new < hi):
+            new = x - f / d1 if d1 != 0.0 else numpy.nan
+        if not (lo < new < hi):
+            rejected += 1
+            if numpy.isfinite(hi):
+                new = 0.5 * (lo + hi)
+            elif bracketed:
+                #Root above x: double the growth factor 1 + r
+                new = 2.0 * x + 1.0
+            else:
+                new = 0.5 * (lo + x)
+            if new == x or new <= -1.0:
+                break
+        elif abs(new - x) <= tol * (1.0 + abs(new)):
+            x = new
+            converged = True
+            break
+        x = new
+        if rejected >= 3 and bracketed and numpy.isfinite(hi):
+            break
+    if not converged and bracketed and numpy.isfinite(hi):
+        from scipy import optimize as opt
+        method = 'brent'
+        x, result = opt.brentq(lambda r: _Valuation(r,v0,v1,weights,cfs)[0],lo,hi,
+                               xtol=tol,rtol=4*EPSILON,full_output=True,disp=False)
+        nfev += result.function_calls
+        it += result.iterations
+        converged = result.converged
+        f = _Valuation(x,v0,v1,weights,cfs)[0]
+    elif converged:
+        f = _Valuation(x,v0,v1,weights,cfs)[0]
+    return x, {'Converged': converged,
+               'Iterations': it,
+               'FunctionEvaluations': nfev,
+               'Residual': f,
+               'Method': method,
+               'Bracket': (lo,hi)}
+
+
+class LinkedReturn:
+    """
+    Time-weighted return of a CashFlowStream: the period is cut into sub-periods at 
+    the dates of the valuations of the portfolio, the return of each sub-period is
+    computed with the Modified Dietz or Modified IRR method and the returns are 
+    chained geometrically
+    
+    The sub-period returns and their cumulative products are cached. A new 
+    valuation or cash flow added through this class only invalidates the 
+    sub-periods it falls in, and the cumulative products are recomputed from the
+    first invalidated sub-period, so that appending a valuation at the end of the
+    history costs a single sub-period computation
+    
+    A cash flow at a valuation date belongs to the sub-period starting at this 
+    date (the valuation is taken before the cash flow), except at the end of the
+    period
+    """
+    def __init__(self,stream,method='dietz'):
+        """
+        Parameters
+        ----------
+        stream: CashFlowStream
+            Cash flows and valuations of the portfolio. Later changes must be made
+            through AddCashFlow and AddValuation, else call Reset
+        method: str (optional)
+            Method of the sub-period returns: 'dietz' (Modified Dietz, default) or 
+            'irr' (Modified IRR)
+        """
+        if method not in ['dietz','irr']:
+            raise ValueError("Unknown return method: {}".format(method))
+        self.Stream = stream
+        self.Method = method
+        #Number of sub-period returns computed since the creation
+        self.NSolve = 0
+        self.Reset()
+        
+    def Reset(self):
+        """
+        Rebuild the sub-periods from the valuations of the stream and invalidate 
+        all the cached returns
+        """
+        ndays = self.Stream.NDays
+        self.Dates = [0.0] + sorted(d for d in self.Stream.Valuations if 0 < d < ndays)
+        if ndays > 0:
+            self.Dates.append(ndays)
+        n = len(self.Dates) - 1
+        #Return of each sub-period and cumulative growth (1 + r) at its end, None 
+        #if not computed
+        self._Returns = [None] * n
+        self._Growth = [None] * n
+        self._First = 0
         
+    def _Invalidate(self,i):
+        """
+        Invalidate the cached return of a sub-period
         
-cf = CashFlowStream(100000.0,110550.0,30.0)
-cf.AddCashFlow(5.0,10000.0)
-print("Modified IRR = {}".format(cf.ModifiedIRR()))
-print("Modified Dietz = {}".format(cf.ModifiedDietz()))
+        Parameters
+        ----------
+        i: int
+            Index of the sub-period
+        """
+        if 0 <= i < len(self._Returns):
+            self._Returns[i] = None
+            self._First = min(self._First,i)
+        
+    def _Period(self,date):
+        """
+        Returns the index of the sub-period containing a date
+        
+        Parameters
+        ----------
+        date: float
+            Number of days (or subperiod)
+            
+        Returns
+        -------
+        type: int
+            Index of the sub-period
+        """
+        return min(bisect.bisect_right(self.Dates,date) - 1,len(self._Returns) - 1)
+        
+    def AddCashFlow(self,date,cf):
+        """
+        Add (or replace) an external cash flow inside the period, possibly 
+        back-dated
+        
+        Parameters
+        ----------
+        date: float
+            Number of days (or subperiod) at which the external cash flow occurs
+        cf: float
+            Value of the cash flow
+        """
+        if not 0 <= date <= self.Stream.NDays:
+            raise ValueError("Cash flow date {} outside of the period".format(date))
+        self.Stream.AddCashFlow(date,cf)
+        self._Invalidate(self._Period(date))
+        
+    def AddValuation(self,date,value):
+        """
+        Add (or replace) a valuation of the portfolio. A valuation after the end of 
+        the period extends it: the previous ending value becomes an interim 
+        valuation and a sub-period is appended
+        
+        Parameters
+        ----------
+        date: float
+            Number of days (or subperiod) at which the portfolio is valued
+        value: float
+            Value of the portfolio (before the cash flows of the date)
+        """
+        stream = self.Stream
+        if date < 0:
+            raise ValueError("Valuation date {} before the start of the period".format(date))
+        if date > stream.NDays:
+            if stream.NDays > 0:
+                stream.Valuations[stream.NDays] = stream.EndingValue
+            #The cash flows at the previous end move to the new sub-period
+            self._Invalidate(len(self._Returns) - 1)
+            stream.NDays = date
+            stream.EndingValue = value
+            self.Dates.append(date)
+            self._Returns.append(None)
+            self._Growth.append(None)
+            self._Invalidate(len(self._Returns) - 1)
+            return
+        if date == 0:
+            stream.InitialValue = value
+            self._Invalidate(0)
+            return
+        if date == stream.NDays:
+            stream.EndingValue = value
+            self._Invalidate(len(self._Returns) - 1)
+            return
+        stream.Valuations[date] = value
+        i = bisect.bisect_left(self.Dates,date)
+        if self.Dates[i] == date:
+            self._Invalidate(i - 1)
+            self._Invalidate(i)
+            return
+        #Split of the sub-period i - 1
+        self.Dates.insert(i,date)
+        self._Returns.insert(i,None)
+        self._Growth.insert(i,None)
+        self._Invalidate(i - 1)
+        self._Invalidate(i)
+        
+    def _Update(self):
+        """
+        Compute the invalidated sub-period returns and the cumulative growth from 
+        the first invalidated sub-period
+        """
+        n = len(self._Returns)
+        if self._First >= n:
+            return
+        stream = self.Stream
+        growth = 1.0 if self._First == 0 else self._Growth[self._First - 1]
+        for i in range(self._First,n):
+            if self._Returns[i] is None:
+                start, end, closed = self.Dates[i], self.Dates[i + 1], i == n - 1
+                if self.Method == 'dietz':
+                    self._Returns[i] = stream.ModifiedDietz(start,end,closed)
+                else:
+                    self._Returns[i] = stream.ModifiedIRR(start,end,closed)
+                self.NSolve += 1
+            growth *= 1.0 + self._Returns[i]
+            self._Growth[i] = growth
+        self._First = n
+        
+    def SubPeriodReturns(self):
+        """
+        Returns the return of each sub-period
+        
+        Returns
+        -------
+        type: list
+            Sub-period returns, in the order of the dates
+        """
+        self._Update()
+        return list(self._Returns)
+        
+    def CumulativeReturns(self):
+        """
+        Returns the linked return from the start of the period to the end of each 
+        sub-period
+        
+        Returns
+        -------
+        type: list
+            Cumulative returns, in the order of the dates
+        """
+        self._Update()
+        return [g - 1.0 for g in self._Growth]
+        
+    def Return(self):
+        """
+        Returns the time-weighted return of the whole period
+        
+        Returns
+        -------
+        type: float
+            Linked return
+        """
+        self._Update()
+        return self._Growth[-1] - 1.0 if self._Growth else 0.0
+        
+        
+class CashFlowBatch:
+    """
+    Cash flow streams of many accounts over their own period, stored as columnar
+    arrays. The returns of all the accounts are computed at once with segment 
+    reductions (one weighted bincount per pass over the cash flows)
+    """
+    def __init__(self,accounts,v0,v1,ndays):
+        """
+        Parameters
+        ----------
+        accounts: array-like
+            Unique identifiers of the accounts
+        v0: float/array-like
+            Initial value of the portfolio of each account
+        v1: float/array-like
+            Ending value of the portfolio of each account
+        ndays: float/array-like
+            Number of days in the period of each account
+        """
+        self.Accounts = numpy.asarray(accounts)
+        n = self.Accounts.shape[0]
+        self.InitialValue = numpy.broadcast_to(numpy.asarray(v0,dtype=float),(n,)).copy()
+        self.EndingValue = numpy.broadcast_to(numpy.asarray(v1,dtype=float),(n,)).copy()
+        self.NDays = numpy.broadcast_to(numpy.asarray(ndays,dtype=float),(n,)).copy()
+        self._Order = numpy.argsort(self.Accounts,kind='stable')
+        if n > 1 and numpy.any(self.Accounts[self._Order][1:] == self.Accounts[self._Order][:-1]):
+            raise ValueError("Account identifiers must be unique")
+        #Columnar cash flows: row of the account, date and amount
+        self.Index = numpy.empty(0,dtype=numpy.intp)
+        self.Dates = numpy.empty(0)
+        self.Amounts = numpy.empty(0)
+        self.Diagnostics = {}
+        
+    def _Rows(self,accounts):
+        """
+        Returns the row of each account identifier
+        
+        Parameters
+        ----------
+        accounts: numpy.ndarray
+            Account identifiers
+            
+        Returns
+        -------
+        type: numpy.ndarray
+            Row indices in the per-account arrays
+        """
+        sortedids = self.Accounts[self._Order]
+        pos = numpy.clip(numpy.searchsorted(sortedids,accounts),0,max(0,sortedids.shape[0] - 1))
+        if sortedids.shape[0] == 0 or numpy.any(sortedids[pos] != accounts):
+            raise ValueError("Unknown account identifier")
+        return self._Order[pos]
+        
+    def AddCashFlows(self,accounts,dates,cfs):
+        """
+        Add external cash flows
+        
+        Parameters
+        ----------
+        accounts: array-like
+            Account identifier of each cash flow
+        dates: array-like
+            Number of days (or subperiod) at which each cash flow occurs
+        cfs: array-like
+            Value of each cash flow
+            
+        Returns
+        -------
+        None
+        """
+        rows = self._Rows(numpy.asarray(accounts))
+        self.Index = numpy.concatenate((self.Index,rows))
+        self.Dates = numpy.concatenate((self.Dates,numpy.asarray(dates,dtype=float)))
+        self.Amounts = numpy.concatenate((self.Amounts,numpy.asarray(cfs,dtype=float)))
+        
+    def _Weights(self):
+        """
+        Returns the weight (NDays - d)/NDays of each cash flow
+        """
+        ndays = self.NDays[self.Index]
+        return (ndays - self.Dates) / ndays
+        
+    def ModifiedDietz(self):
+        """
+        Compute the Modified Dietz return of every account
+        
+        Parameters
+        ----------
+        None
+        
+        Returns
+        -------
+        type: numpy.ndarray
+            Modified Dietz return of each account
+        """
+        n = self.Accounts.shape[0]
+        total = numpy.bincount(self.Index,self.Amounts,minlength=n)
+        weigthedCF = numpy.bincount(self.Index,self.Amounts * self._Weights(),minlength=n)
+        return (self.EndingValue - self.InitialValue - total)/(self.InitialValue + weigthedCF)
+    
+    def ModifiedIRR(self,tol=1e-12,maxiter=50):
+        """
+        Compute the Modified IRR of every account, root of
+        
+        sum(cf * (1 + r) ** ((NDays - d)/NDays)) + V0 * (1 + r) - V1 = 0
+        
+        with Newton steps run on all the accounts at once (initial guess: 
+        Modified Dietz return). Only the accounts not converged yet are updated.
+        The accounts still not converged after maxiter iterations are solved one
+        by one with SolveModifiedIRR. The number of iterations and the accounts 
+        which converged are stored in the Diagnostics attribute
+        
+        Parameters
+        ----------
+        tol: float (optional)
+            Relative tolerance on the Newton step (default: 1e-12)
+        maxiter: int (optional)
+            Maximum number of iterations (default: 50)
+            
+        Returns
+        -------
+        type: numpy.ndarray
+            Modified IRR of each account
+        """
+        n = self.Accounts.shape[0]
+        #Start from 0 where the Modified Dietz return is not a valid guess (zero
+        #denominator, or below -100%)
+        with numpy.errstate(divide='ignore',invalid='ignore'):
+            r = self.ModifiedDietz()
+        r[~numpy.isfinite(r) | (r <= -1.0)] = 0.0
+        weights = self._Weights()
+        active = numpy.ones(n,dtype=bool)
+        #Accounts left to the scalar solver (no Newton step: zero derivative)
+        fallback = numpy.zeros(n,dtype=bool)
+        iterations = numpy.zeros(n,dtype=int)
+        for it in range(maxiter):
+            rows = numpy.flatnonzero(active)
+            if rows.shape[0] == 0:
+                break
+            #Cash flows of the active accounts only, rows renumbered 0..len(rows)-1
+            sel = active[self.Index]
+            local = numpy.cumsum(active) - 1
+            idx = local[self.Index[sel]]
+            w = weights[sel]
+            cf = self.Amounts[sel]
+            ra = r[rows]
+            growth = numpy.exp(w * numpy.log1p(ra)[idx])
+            f = numpy.bincount(idx,cf * growth,minlength=rows.shape[0]) + self.InitialValue[rows] * (1.0 + ra) - self.EndingValue[rows]
+            fp = numpy.bincount(idx,cf * w * growth / (1.0 + ra)[idx],minlength=rows.shape[0]) + self.InitialValue[rows]
+            with numpy.errstate(divide='ignore',invalid='ignore'):
+                step = f / fp
+            bad = ~numpy.isfinite(step)
+            step[bad] = 0.0
+            new = ra - step
+            #Keep 1 + r > 0: go halfway to -1 instead
+            out = new <= -1.0
+            new[out] = 0.5 * (ra[out] - 1.0)
+            r[rows] = new
+            iterations[rows] += 1
+            done = numpy.abs(new - ra) <= tol * (1.0 + numpy.abs(new))
+            active[rows[done | bad]] = False
+            fallback[rows[bad]] = True
+        active |= fallback
+        for row in numpy.flatnonzero(active):
+            sel = self.Index == row
+            r[row], diag = SolveModifiedIRR(self.InitialValue[row],self.EndingValue[row],weights[sel],
+                                            self.Amounts[sel],r[row],tol,maxiter)
+            iterations[row] += diag['Iterations']
+            active[row] = not diag['Converged']
+        self.Diagnostics = {'Iterations': iterations,
+                            'Converged': ~active}
+        return r
+
+
+def _ReadGroups(rows,columns):
+    """
+    Group the rows of a ledger by (account, period). The rows of a group must 
+    be contiguous
+    
+    Parameters
+    ----------
+    rows: iterator
+        Rows of the ledger (lists of str), header first
+    columns: tuple
+        Names of the account, period, day, kind and amount columns
+        
+    Returns
+    -------
+    type: generator
+        (account, period, v0, v1, ndays, days, amounts) for each group
+    """
+    header = next(rows,None)
+    if header is None:
+        #Empty ledger: no group
+        return
+    try:
+        iacc, iper, iday, ikind, iamt = [header.index(name) for name in columns]
+    except ValueError as e:
+        raise ValueError("Missing ledger column: {}".format(e))
+    for (account, period), group in itertools.groupby(rows,key=lambda row: (row[iacc],row[iper])):
+        v0 = v1 = ndays = None
+        days = []
+        amounts = []
+        for row in group:
+            kind = row[ikind]
+            if kind == 'flow':
+                days.append(float(row[iday]))
+                amounts.append(float(row[iamt]))
+            elif kind == 'start':
+                v0 = float(row[iamt])
+            elif kind == 'end':
+                v1 = float(row[iamt])
+                ndays = float(row[iday])
+            else:
+                raise ValueError("Unknown ledger row kind: {}".format(kind))
+        if v0 is None or v1 is None:
+            raise ValueError("Missing start or end value for account {} and period {}".format(account,period))
+        yield account, period, v0, v1, ndays, days, amounts
+
+
+def StreamReturns(ledger,method='dietz',chunksize=100000,columns=('account','period','day','kind','amount')):
+    """
+    Compute the return of every account and period of a CSV ledger, reading it 
+    sequentially. Complete (account, period) groups are buffered until about 
+    chunksize rows are read, then their returns are computed at once with a 
+    CashFlowBatch and yielded, so memory does not depend on the size of the file
+    
+    The ledger has one row per value or cash flow: kind 'start' (initial value,
+    day 0), 'end' (ending value, the day being the number of days of the period)
+    or 'flow' (external cash flow at the day). The rows of an (account, period)
+    must be contiguous, e.g. sorted by account and period
+    
+    Parameters
+    ----------
+    ledger: str/file
+        Path of the CSV file, or open file
+    method: str (optional)
+        'dietz' (Modified Dietz, default) or 'irr' (Modified IRR)
+    chunksize: int (optional)
+        Number of rows read between two computations (default: 100000)
+    columns: tuple (optional)
+        Names of the account, period, day, kind and amount columns
+        
+    Returns
+    -------
+    type: generator
+        (account, period, return) for each group, in the order of the ledger
+    """
+    if method not in ['dietz','irr']:
+        raise ValueError("Unknown return method: {}".format(method))
+    if isinstance(ledger,str):
+        with open(ledger,newline='') as f:
+            for result in StreamReturns(f,method,chunksize,columns):
+                yield result
+        return
+    groups = _ReadGroups(csv.reader(ledger),columns)
+    while True:
+        chunk = []
+        nrow = 0
+        for group in groups:
+            chunk.append(group)
+            nrow += len(group[5]) + 2
+            if nrow >= chunksize:
+                break
+        if not chunk:
+            return
+        batch = CashFlowBatch(numpy.arange(len(chunk)),[g[2] for g in chunk],[g[3] for g in chunk],[g[4] for g in chunk])
+        sizes = [len(g[5]) for g in chunk]
+        batch.AddCashFlows(numpy.repeat(numpy.arange(len(chunk)),sizes),
+                           list(itertools.chain.from_iterable(g[5] for g in chunk)),
+                           list(itertools.chain.from_iterable(g[6] for g in chunk)))
+        returns = batch.ModifiedDietz() if method == 'dietz' else batch.ModifiedIRR()
+        for g, r in zip(chunk,returns):
+            yield g[0], g[1], float(r)
+
+
+def main(argv=None):
+    """
+    Command line entry point: Modified IRR and Modified Dietz return of a period
+    
+    Parameters
+    ----------
+    argv: list (optional)
+        Command line arguments (default: sys.argv)
+        
+    Returns
+    -------
+    None
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="Modified IRR and Modified Dietz return of a period")
+    parser.add_argument('--v0',type=float,default=100000.0,help="Initial value of the portfolio")
+    parser.add_argument('--v1',type=float,default=110550.0,help="Ending value of the portfolio")
+    parser.add_argument('--ndays',type=float,default=30.0,help="Number of days in the period")
+    parser.add_argument('--cashflow',type=float,nargs=2,action='append',metavar=('DATE','AMOUNT'),
+                        help="External cash flow (repeatable, default: 10000 at day 5)")
+    parser.add_argument('--ledger',default=None,help="CSV ledger: print the return of every account and period (see StreamReturns)")
+    parser.add_argument('--method',choices=['dietz','irr'],default='dietz',help="Return method of the ledger")
+    args = parser.parse_args(argv)
+    if args.ledger is not None:
+        for account, period, r in StreamReturns(args.ledger,args.method):
+            print("{},{},{}".format(account,period,r))
+        return
+    cf = CashFlowStream(args.v0,args.v1,args.ndays)
+    for date, amount in args.cashflow or [(5.0,10000.0)]:
+        cf.AddCashFlow(date,amount)
+    print("Modified IRR = {}".format(cf.ModifiedIRR()))
+    print("Modified Dietz = {}".format(cf.ModifiedDietz()))
+
+
+if __name__ == '__main__':
+    main()
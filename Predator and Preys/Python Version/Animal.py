@@ -5,9 +5,7 @@ Created on Fri Jan 27 22:20:54 2017
 @author: clem
 """
 
-import matplotlib.pyplot as plt
 import numpy as np
-import scipy.stats as st
 
 #########################################################################################
 #                          Abstract Animal Class (Prey and Predator Basis)
@@ -81,7 +79,7 @@ class Animal:
         self.X = self.X + dMov["dx"]
         self.Y = self.Y + dMov["dy"]
         if self.Record:
-            self.Past_Move = vstack((self.Past_Move,np.array([[self.X,self.Y]])))
+            self.Past_Move = np.vstack((self.Past_Move,np.array([[self.X,self.Y]])))
     
     def Plot_Path(self):
         """
@@ -95,6 +93,7 @@ class Animal:
         -------
         None
         """
+        import matplotlib.pyplot as plt
         try:
             plt.plot(self.Past_Move[:,0],self.Past_Move[:,1])
         except:
@@ -331,20 +330,55 @@ class Map:
 #                                   Main
 ###################################################################################
 
-m = Map(100,-2000,2000,50)
-
-mov = lambda x, y: {"dx": x * np.cos(y * 2.0 * np.pi), "dy": x * np.sin(y * 2.0 * np.pi)}
-st.cauchy.a = 0
-st.cauchy.b = 2
-m.Set_Predator_Generator(st.cauchy.rvs,np.random.uniform)
-m.Set_Predator_Movement(mov)
-m.Set_Recorder(True,True)
-
-movprey = lambda x, y: {"dx": x, "dy": y}
-m.Set_Prey_Movement(movprey)
+def main(argv=None):
+    """
+    Run a map with a predator moving with Cauchy-distributed jumps in random 
+    directions and preys moving with normal increments
+    
+    Parameters
+    ----------
+    argv: list (optional)
+        Command line arguments (default: sys.argv)
+        
+    Returns
+    -------
+    None
+    """
+    import argparse
+    import scipy.stats as st
+    parser = argparse.ArgumentParser(description="Predator and preys simulation")
+    parser.add_argument('--preys',type=int,default=100,help="Number of preys")
+    parser.add_argument('--xmin',type=float,default=-2000.0)
+    parser.add_argument('--xmax',type=float,default=2000.0)
+    parser.add_argument('--catch',type=float,default=50.0,help="Catch distance")
+    parser.add_argument('--iter',type=int,default=2000,help="Maximum number of iterations")
+    parser.add_argument('--seed',type=int,default=None)
+    parser.add_argument('--plot',action='store_true',help="Plot the paths of the animals")
+    args = parser.parse_args(argv)
+    if args.seed is not None:
+        np.random.seed(args.seed)
+    
+    m = Map(args.preys,args.xmin,args.xmax,args.catch)
+    
+    mov = lambda x, y: {"dx": x * np.cos(y * 2.0 * np.pi), "dy": x * np.sin(y * 2.0 * np.pi)}
+    st.cauchy.a = 0
+    st.cauchy.b = 2
+    m.Set_Predator_Generator(st.cauchy.rvs,np.random.uniform)
+    m.Set_Predator_Movement(mov)
+    m.Set_Recorder(args.plot,args.plot)
+    
+    movprey = lambda x, y: {"dx": x, "dy": y}
+    m.Set_Prey_Movement(movprey)
+    
+    m.Run(args.iter)
+    
+    if args.plot:
+        import matplotlib.pyplot as plt
+        m.Predator.Plot_Path()
+        for p in m.Preys:
+            p.Plot_Path()
+        plt.show()
 
-m.Run(2000)
 
-m.Predator.Plot_Path()
-for p in m.Preys:
-    p.Plot_Path()
+if __name__ == '__main__':
+    main()